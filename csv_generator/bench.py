@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Модуль для измерения производительности стадий создания архивов и
+генерации csv-файлов.
+
+Замер для заданных количеств архивов, xml-файлов в архиве, элементов object
+в xml-файле и процессов:
+>>> ./bench.py -a 10,50 -x 100 -b 1,10 -j 1,4 -o run.json
+
+Сравнение двух сохранённых замеров:
+>>> ./bench.py --compare base.json run.json
+'''
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import contextlib
+from gen import ArchGen, CsvGen, run_tasks
+
+
+STAGES = ["render", "zip", "extract", "parse", "join"]
+
+
+def render_archive(arch_gen, zip_id):
+    '''
+    Генерирует xml-файлы одного архива без сохранения. Возвращает суммарный
+    размер сгенерированного текста.
+
+    :param arch_gen: объект ArchGen с параметрами генерации
+    :param zip_id: номер архива
+    '''
+    return sum(len(xml_file.xml_content())
+               for xml_fname, xml_file in arch_gen.xml_files(zip_id))
+
+
+def dir_size(path, predicate):
+    '''
+    Возвращает суммарный размер файлов каталога, имена которых
+    удовлетворяют predicate.
+
+    :param path: путь к каталогу
+    :param predicate: функция, принимающая имя файла
+    '''
+    total = 0
+    for root, dirnames, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, fname))
+                     for fname in filenames if predicate(fname))
+    return total
+
+
+def stage_result(seconds, docs, rows, nbytes):
+    '''
+    Возвращает показатели стадии.
+
+    :param seconds: время выполнения стадии
+    :param docs: количество обработанных xml-файлов
+    :param rows: количество обработанных строк csv-файлов
+    :param nbytes: объём обработанных данных
+    '''
+    seconds = max(seconds, 1e-9)
+    return {
+        "seconds": seconds,
+        "docs_per_sec": docs / seconds,
+        "rows_per_sec": rows / seconds,
+        "mb_per_sec": nbytes / seconds / (1024 * 1024),
+    }
+
+
+def measure(path, arch_count, xml_count, nobjects, jobs):
+    '''
+    Выполняет все стадии для одного набора параметров и возвращает
+    показатели каждой стадии.
+
+    :param path: рабочий каталог, который очищается перед замером
+    :param arch_count: количество архивов
+    :param xml_count: количество xml-файлов в архиве
+    :param nobjects: количество элементов object в xml-файле
+    :param jobs: количество процессов
+    '''
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+    docs = arch_count * xml_count
+    arch_gen = ArchGen(path, arch_count, xml_count, jobs=jobs,
+                       nobjects=nobjects)
+    csv_gen = CsvGen(path, jobs, "extract", ordered=True)
+    zip_ids = [(arch_gen, j) for j in range(1, arch_count + 1)]
+    stages = {}
+
+    st = time.perf_counter()
+    nbytes = sum(run_tasks(render_archive, zip_ids, jobs))
+    stages["render"] = stage_result(time.perf_counter() - st, docs, 0, nbytes)
+
+    st = time.perf_counter()
+    arch_gen.zip_all()
+    stages["zip"] = stage_result(
+        time.perf_counter() - st, docs, 0,
+        dir_size(path, lambda fname: fname.endswith(".zip")))
+
+    archives = csv_gen.list_archives()
+    st = time.perf_counter()
+    csv_gen.handle_archives(archives)
+    elapsed = time.perf_counter() - st
+    xml_bytes = dir_size(path, lambda fname: fname.endswith(".xml"))
+    stages["extract"] = stage_result(elapsed, docs, 0, xml_bytes)
+
+    st = time.perf_counter()
+    counts = run_tasks(csv_gen.parse_xml_files,
+                       [("{}.d".format(fname),) for fname in archives], jobs)
+    rows = sum(c["levels_rows"] + c["objects_rows"] for c in counts)
+    stages["parse"] = stage_result(time.perf_counter() - st, docs, rows,
+                                   xml_bytes)
+
+    nbytes = dir_size(path, lambda fname: fname.endswith(".csv"))
+    st = time.perf_counter()
+    run_tasks(csv_gen.join_csv_files, [("levels",), ("objects",)], jobs)
+    stages["join"] = stage_result(time.perf_counter() - st, docs, rows,
+                                  nbytes)
+    shutil.rmtree(path)
+    return stages
+
+
+def compare(base_fpath, new_fpath, threshold):
+    '''
+    Сравнивает два замера по числу xml-файлов в секунду для каждой стадии.
+    Возвращает True, если ни одна стадия не замедлилась больше, чем на
+    threshold.
+
+    :param base_fpath: путь к базовому замеру
+    :param new_fpath: путь к новому замеру
+    :param threshold: допустимое относительное замедление
+    '''
+    def runs(fpath):
+        with open(fpath, "r") as f:
+            data = json.load(f)
+        return dict(((r["archives"], r["xml"], r["objects"], r["jobs"]),
+                     r["stages"]) for r in data["runs"])
+
+    base = runs(base_fpath)
+    new = runs(new_fpath)
+    ok = True
+    for key in sorted(set(base) & set(new)):
+        for stage in STAGES:
+            old_rate = base[key][stage]["docs_per_sec"]
+            new_rate = new[key][stage]["docs_per_sec"]
+            change = new_rate / old_rate - 1.0
+            regression = change < -threshold
+            ok = ok and not regression
+            print("archives={0} xml={1} objects={2} jobs={3} "
+                  "{stage:8} {old:12.1f} -> {new:12.1f} docs/s "
+                  "{change:+7.1%}{mark}".format(
+                    *key, stage=stage, old=old_rate, new=new_rate,
+                    change=change, mark=" REGRESSION" if regression else ""))
+    return ok
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description="Замер производительности архиватора и "
+                            "csv генератора.")
+    parser.add_argument("-p", "--path", type=str,
+                        help="Рабочий каталог. По умолчанию создаётся "
+                             "временный каталог.")
+    parser.add_argument("-a", "--archcount", type=int_list, default=[10],
+                        help="Список количеств архивов через запятую. "
+                             "По умолчанию: 10.")
+    parser.add_argument("-x", "--xmlcount", type=int_list, default=[100],
+                        help="Список количеств xml-файлов в архиве через "
+                             "запятую. По умолчанию: 100.")
+    parser.add_argument("-b", "--objects", type=int_list, default=[5],
+                        help="Список количеств элементов object в xml-файле "
+                             "через запятую. По умолчанию: 5.")
+    parser.add_argument("-j", "--jobs", type=int_list,
+                        default=[os.cpu_count() or 1],
+                        help="Список количеств процессов через запятую. "
+                             "По умолчанию равно количеству процессоров.")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Файл для сохранения результатов в формате "
+                             "JSON. По умолчанию результаты выводятся "
+                             "на экран.")
+    parser.add_argument("--compare", type=str, nargs=2,
+                        metavar=("BASE", "NEW"),
+                        help="Сравнить два сохранённых замера. Код возврата "
+                             "равен 1, если обнаружено замедление.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Допустимое относительное замедление при "
+                             "сравнении. По умолчанию: 0.1.")
+    args = parser.parse_args()
+
+    if args.compare:
+        if not compare(args.compare[0], args.compare[1], args.threshold):
+            sys.exit(1)
+        return
+
+    work_path = args.path or tempfile.mkdtemp(prefix="csv_bench.")
+    runs = []
+    for arch_count, xml_count, nobjects, jobs in itertools.product(
+            args.archcount, args.xmlcount, args.objects, args.jobs):
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            stages = measure(os.path.join(work_path, "run"), arch_count,
+                             xml_count, nobjects, jobs)
+        runs.append({"archives": arch_count, "xml": xml_count,
+                     "objects": nobjects, "jobs": jobs, "stages": stages})
+        print("archives={} xml={} objects={} jobs={}: {}".format(
+                arch_count, xml_count, nobjects, jobs,
+                ", ".join("{} {:.3f}s".format(stage, stages[stage]["seconds"])
+                          for stage in STAGES)),
+              file=sys.stderr)
+    if not args.path:
+        shutil.rmtree(work_path)
+    report = json.dumps({"runs": runs}, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
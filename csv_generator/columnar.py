@@ -0,0 +1,251 @@
+'''
+Модуль содержит классы для сохранения извлечённых значений в двоичном
+поколоночном формате.
+
+Каждая колонка хранится в отдельном файле {набор}.{колонка}.bin как
+последовательность целых чисел фиксированной ширины в порядке байтов
+little-endian (см. COLUMNS). Имена объектов закодированы номерами в
+словаре objects.name.dict, в каждой строке которого записано одно имя в
+виде JSON-строки; номер имени равен номеру строки, начиная с нуля. Все
+файлы только дописываются, поэтому их можно обрезать до прежних размеров
+(см. manifest.Manifest.truncate_outputs). Колонки отображаются в память
+без разбора (см. open_columns).
+'''
+
+
+import os
+import sys
+import json
+import mmap
+import pickle
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Колонки: набор данных, имя колонки и код типа array ("q" - int64,
+# "i" - int32).
+COLUMNS = (
+    ("levels", "id", "q"),
+    ("levels", "level", "i"),
+    ("objects", "id", "q"),
+    ("objects", "name", "i"),
+)
+
+DICT_FNAME = "objects.name.dict"
+
+
+def column_fname(dataset, column):
+    '''
+    Возвращает имя файла колонки.
+
+    :param dataset: набор данных (levels или objects)
+    :param column: имя колонки
+    '''
+    return "{}.{}.bin".format(dataset, column)
+
+
+# Все итоговые файлы поколоночного формата.
+OUTPUT_FILES = [column_fname(dataset, column)
+                for dataset, column, typecode in COLUMNS] + [DICT_FNAME]
+
+
+def to_le_bytes(values):
+    '''
+    Возвращает значения массива array в порядке байтов little-endian.
+
+    :param values: объект array
+    '''
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_le_bytes(typecode, data):
+    '''
+    Возвращает массив array из байтов в порядке little-endian.
+
+    :param typecode: код типа array
+    :param data: байты значений
+    '''
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class ColumnarWriter(object):
+    '''
+    Накапливает значения, извлечённые из xml-файлов, в колонках в памяти.
+    Имена объектов кодируются номерами в локальном словаре писателя.
+    Интерфейс совпадает с xmlhandler.CsvWriter. Значения id и level должны
+    быть целыми числами.
+    '''
+
+    def __init__(self):
+        self.columns = dict(((dataset, column), array(typecode))
+                            for dataset, column, typecode in COLUMNS)
+        self.names = []
+        self.codes = {}
+        self.levels_rows = 0
+        self.objects_rows = 0
+
+    def write(self, var_values, object_names):
+        '''
+        Сохраняет значения одного xml-файла.
+
+        :param var_values: словарь значений переменных id и level
+        :param object_names: список имён объектов
+        '''
+        value_id = int(var_values["id"])
+        self.columns["levels", "id"].append(value_id)
+        self.columns["levels", "level"].append(int(var_values["level"]))
+        ids = self.columns["objects", "id"]
+        names = self.columns["objects", "name"]
+        for name in object_names:
+            code = self.codes.get(name)
+            if code is None:
+                code = self.codes[name] = len(self.names)
+                self.names.append(name)
+            ids.append(value_id)
+            names.append(code)
+        self.levels_rows += 1
+        self.objects_rows += len(object_names)
+
+    def chunk(self):
+        '''
+        Возвращает накопленные значения в виде, пригодном для передачи между
+        процессами и для ColumnarStore.append: словарь с байтами колонок
+        columns и локальным словарём имён names.
+        '''
+        return {"columns": dict((key, to_le_bytes(values))
+                                for key, values in self.columns.items()),
+                "names": self.names}
+
+    def save(self, fpath):
+        '''
+        Сохраняет накопленные значения в промежуточный файл.
+
+        :param fpath: путь к промежуточному файлу
+        '''
+        with open(fpath, "wb") as f:
+            pickle.dump(self.chunk(), f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_chunk(fpath):
+    '''
+    Загружает значения, сохранённые ColumnarWriter.save.
+
+    :param fpath: путь к промежуточному файлу
+    '''
+    with open(fpath, "rb") as f:
+        return pickle.load(f)
+
+
+class ColumnarStore(object):
+    '''
+    Итоговые файлы поколоночного формата. Дописывает в них значения,
+    накопленные ColumnarWriter, перекодируя номера имён объектов из
+    локального словаря писателя в общий словарь.
+    '''
+
+    def __init__(self, out_path, append=False):
+        '''
+        :param out_path: каталог для итоговых файлов
+        :param append: дописывать значения в существующие файлы
+        '''
+        self.out_path = out_path
+        file_mode = "ab" if append else "wb"
+        self.files = dict(
+            ((dataset, column),
+             open(os.path.join(out_path, column_fname(dataset, column)),
+                  file_mode))
+            for dataset, column, typecode in COLUMNS)
+        self.codes = {}
+        dict_fpath = os.path.join(out_path, DICT_FNAME)
+        if append and os.path.exists(dict_fpath):
+            with open(dict_fpath, "r", encoding="utf-8") as f:
+                for line in f:
+                    self.codes[json.loads(line)] = len(self.codes)
+        self.dict_file = open(dict_fpath, "a" if append else "w",
+                              encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.dict_file.close()
+
+    def append(self, chunk):
+        '''
+        Дописывает значения в итоговые файлы. Возвращает количество
+        записанных байт.
+
+        :param chunk: значения, возвращённые ColumnarWriter.chunk
+        '''
+        mapping = []
+        for name in chunk["names"]:
+            code = self.codes.get(name)
+            if code is None:
+                code = self.codes[name] = len(self.codes)
+                self.dict_file.write(json.dumps(name) + "\n")
+            mapping.append(code)
+        nbytes = 0
+        for dataset, column, typecode in COLUMNS:
+            data = chunk["columns"][dataset, column]
+            if column == "name" and mapping != list(range(len(mapping))):
+                data = self.recode(typecode, data, mapping)
+            self.files[dataset, column].write(data)
+            nbytes += len(data)
+        return nbytes
+
+    @staticmethod
+    def recode(typecode, data, mapping):
+        '''
+        Заменяет локальные номера имён объектов номерами общего словаря.
+        При наличии NumPy замена выполняется векторно.
+
+        :param typecode: код типа array колонки
+        :param data: байты колонки в порядке little-endian
+        :param mapping: номера общего словаря по локальным номерам
+        '''
+        if numpy is not None:
+            codes = numpy.frombuffer(data, dtype="<i4")
+            return numpy.asarray(mapping, dtype="<i4")[codes].tobytes()
+        return to_le_bytes(array(typecode, (mapping[code] for code in
+                                            from_le_bytes(typecode, data))))
+
+
+def open_columns(out_path):
+    '''
+    Отображает итоговые файлы поколоночного формата в память без разбора.
+    Возвращает словарь объектов memoryview по парам (набор данных, имя
+    колонки) и список имён объектов словаря. Значения колонок
+    интерпретируются в порядке байтов платформы, поэтому функция
+    предназначена для little-endian платформ.
+
+    :param out_path: каталог с итоговыми файлами
+    '''
+    columns = {}
+    for dataset, column, typecode in COLUMNS:
+        fpath = os.path.join(out_path, column_fname(dataset, column))
+        with open(fpath, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = b""
+        columns[dataset, column] = memoryview(buf).cast(typecode)
+    with open(os.path.join(out_path, DICT_FNAME), "r",
+              encoding="utf-8") as f:
+        names = [json.loads(line) for line in f]
+    return columns, names
@@ -4,20 +4,220 @@
 '''
 
 
+import io
 import os
+import re
+import stat
+import struct
+import errno
+import time
+import shutil
 import zipfile
-import multiprocessing
-from xmlhandler import XmlHandler, RequiredAttrError
-import xml.sax
-from glob import glob
-from xmlfile import XmlFile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from xmlhandler import CsvWriter, RequiredAttrError, make_engine
+from xmlfile import XmlFile, get_template, gen_batch
+from columnar import ColumnarWriter, ColumnarStore, load_chunk, OUTPUT_FILES
+from pipeline import CsvPipeline
+from manifest import Manifest, file_hash
+from shards import shard_of, shard_dirname
+from idindex import build_index, DATA_FILES
+from stats import measure_call
 
 
-def wait_for_proc_end(proc):
-    while proc:
-        p = proc.pop()
-        while p.is_alive():
-            pass
+def run_tasks(func, tasks, jobs=None, stats=None, stage=None):
+    '''
+    Выполняет func для каждого набора аргументов из tasks в пуле из jobs
+    процессов и дожидается завершения всех задач. Возвращает список
+    результатов в порядке tasks. Исключение, возникшее в задаче (в том числе
+    аварийное завершение процесса пула), пробрасывается в вызывающий
+    процесс, а ещё не начатые задачи отменяются.
+
+    :param func: функция, выполняемая в процессах пула
+    :param tasks: список кортежей с аргументами func
+    :param jobs: количество процессов в пуле. По умолчанию равно
+                 количеству процессоров
+    :param stats: объект stats.Stats для сбора показателей выполнения
+                  задач. Если не задан, показатели не собираются
+    :param stage: имя стадии, к которой относятся задачи
+    '''
+    tasks = list(tasks)
+    if not tasks:
+        return []
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        if stats is None:
+            futures = [executor.submit(func, *args) for args in tasks]
+            results = [f.result() for f in futures]
+        else:
+            def add_metrics(future):
+                if not future.cancelled() and future.exception() is None:
+                    stats.add(stage, future.result()[1])
+
+            with stats.stage(stage, len(tasks)):
+                futures = [executor.submit(measure_call, func, args)
+                           for args in tasks]
+                for f in futures:
+                    f.add_done_callback(add_metrics)
+                results = [f.result()[0] for f in futures]
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+    return results
+
+
+def natural_key(name):
+    '''
+    Ключ сортировки имён файлов, при котором числа в имени сравниваются как
+    числа: a_2.zip идёт раньше a_10.zip.
+
+    :param name: имя файла
+    '''
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r"(\d+)", name)]
+
+
+# Ошибки, при которых копирование средствами ядра не поддерживается для
+# заданной пары файлов и нужно перейти к следующему способу копирования.
+COPY_FALLBACK_ERRNOS = frozenset([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                  errno.EOPNOTSUPP, errno.ENOTSUP,
+                                  errno.EBADF])
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def append_file(dst_file, src_fpath):
+    '''
+    Дописывает содержимое файла src_fpath в файл dst_file, открытый на
+    запись в двоичном режиме без буферизации. Данные копируются внутри ядра
+    с помощью os.copy_file_range, а если он недоступен - с помощью
+    os.sendfile. Если не работает ни один из них, файл копируется частями
+    по COPY_CHUNK_SIZE байт. Расход памяти не зависит от размера файла.
+
+    :param dst_file: файловый объект, в который дописываются данные
+    :param src_fpath: путь к копируемому файлу
+    '''
+    dst_fd = dst_file.fileno()
+    with open(src_fpath, "rb") as src_file:
+        src_fd = src_file.fileno()
+        size = os.fstat(src_fd).st_size
+        offset = 0
+        copy_funcs = []
+        if hasattr(os, "copy_file_range"):
+            copy_funcs.append(lambda count: os.copy_file_range(
+                                    src_fd, dst_fd, count, offset))
+        if hasattr(os, "sendfile"):
+            copy_funcs.append(lambda count: os.sendfile(
+                                    dst_fd, src_fd, offset, count))
+        for copy in copy_funcs:
+            try:
+                while offset < size:
+                    copied = copy(min(size - offset, 1 << 30))
+                    if not copied:
+                        break
+                    offset += copied
+                return
+            except OSError as exc:
+                if exc.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+        src_file.seek(offset)
+        shutil.copyfileobj(src_file, dst_file, COPY_CHUNK_SIZE)
+
+
+# Способы сжатия xml-файлов в архиве.
+COMPRESSIONS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+
+# Записи zip-архива (см. спецификацию формата zip, APPNOTE.TXT): запись
+# центрального каталога без имени файла и дополнительных полей и запись
+# конца центрального каталога без комментария.
+CENTRAL_DIR = struct.Struct("<4s4B4HL2L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD_SIGNATURE = b"PK\x05\x06"
+
+# Ограничения, при превышении которых zipfile записывает архив в формате
+# zip64 (zipfile.ZIP64_LIMIT и ZIP_FILECOUNT_LIMIT).
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+
+def compress_members(members, renderer, compression, compresslevel,
+                     file_mode):
+    '''
+    Генерирует и сжимает часть xml-файлов архива, собираемого в режиме
+    parallel. Выполняется в отдельном процессе. Файлы записываются
+    стандартным zipfile в архив в памяти, поэтому записи архива совпадают с
+    теми, что записываются в других режимах. Возвращает количество файлов
+    files, локальные заголовки вместе со сжатыми данными data, их размер
+    bytes и записи центрального каталога central_dir со смещениями
+    относительно начала data.
+
+    :param members: список кортежей из номера xml-файла, времени изменения
+                    и случайных значений файла (см. xmlfile.gen_batch)
+    :param renderer: способ генерации xml-текста из xmlfile.RENDERERS
+    :param compression: способ сжатия из значений COMPRESSIONS
+    :param compresslevel: степень сжатия или None
+    :param file_mode: права, записываемые для xml-файлов
+    '''
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", allowZip64=False) as zf:
+        for xml_id, date_time, xml_values in members:
+            zinfo = zipfile.ZipInfo(
+                        ArchGen.xml_templ_name.format(n=xml_id), date_time)
+            zinfo.external_attr = file_mode << 16
+            xml_file = XmlFile(xml_id, renderer=renderer, values=xml_values)
+            zf.writestr(zinfo, xml_file.xml_content(),
+                        compress_type=compression,
+                        compresslevel=compresslevel)
+    archive = buf.getvalue()
+    end = END_RECORD.unpack_from(archive, len(archive) - END_RECORD.size)
+    (count, dir_size, dir_offset) = end[4:7]
+    return {"files": count, "bytes": dir_offset,
+            "data": archive[:dir_offset],
+            "central_dir": archive[dir_offset:dir_offset + dir_size]}
+
+
+def shift_central_dir(central_dir, offset):
+    '''
+    Возвращает записи центрального каталога, в которых смещения локальных
+    заголовков увеличены на offset.
+
+    :param central_dir: записи центрального каталога
+    :param offset: смещение части архива от начала архива
+    '''
+    records = bytearray(central_dir)
+    pos = 0
+    while pos < len(records):
+        fields = list(CENTRAL_DIR.unpack_from(records, pos))
+        fields[18] += offset
+        CENTRAL_DIR.pack_into(records, pos, *fields)
+        # За записью следуют имя файла, дополнительные поля и комментарий.
+        pos += CENTRAL_DIR.size + sum(fields[12:15])
+    return bytes(records)
+
+
+def build_indexes(out_path, output_format, jobs=None, stats=None):
+    '''
+    Строит индексы итоговых файлов levels и objects по значению id в пуле
+    процессов (см. idindex.build_index).
+
+    :param out_path: каталог с итоговыми файлами
+    :param output_format: формат итоговых файлов: csv или columnar
+    :param jobs: количество процессов
+    :param stats: объект stats.Stats для сбора показателей
+    '''
+    run_tasks(build_index,
+              [(os.path.join(out_path, fname), output_format)
+               for fname in DATA_FILES[output_format].values()],
+              jobs, stats, "index")
+    print("The id indexes were created in {}.".format(out_path))
 
 
 class ArchGen(object):
@@ -28,48 +228,276 @@ class ArchGen(object):
     arch_templ_name = "a_{n}.zip"
     xml_templ_name = "t_{n}.xml"
 
-    def __init__(self, path, arch_count, xml_count):
+    gen_modes = ["memory", "file", "parallel"]
+    default_buffer_size = 64 * 1024 * 1024
+
+    # Время изменения элементов архива при заданном seed: минимальное время,
+    # которое можно записать в zip-архив.
+    seed_date_time = (1980, 1, 1, 0, 0, 0)
+
+    def __init__(self, path, arch_count, xml_count, gen_mode="memory",
+                 tmp_path=None, buffer_size=default_buffer_size, jobs=None,
+                 nobjects=None, stats=None, renderer="jinja", seed=None,
+                 compression="stored", level=None):
         '''
-        :param path: путь к каталогу, где генерируются xml-файлы и
-                     создаются архивы
+        :param path: путь к каталогу, где создаются архивы
         :param arch_count: количество создаваемых архивов
         :param xml_count: количество сгенерированных xml-файлов
                           в архиве
+        :param gen_mode: способ помещения xml-файлов в архив: memory -
+                         сгенерированный текст записывается в архив
+                         напрямую; file - через временный файл на диске;
+                         parallel - архивы создаются по одному, xml-файлы
+                         каждого архива генерируются и сжимаются в пуле
+                         процессов, а архив собирается одним процессом
+        :param tmp_path: каталог для временных файлов. По умолчанию
+                         совпадает с path
+        :param buffer_size: размер буфера записи архива в режиме memory
+        :param jobs: количество процессов, создающих архивы. По умолчанию
+                     равно количеству процессоров
+        :param nobjects: количество элементов object в xml-файле. По
+                         умолчанию выбирается случайно для каждого файла
+        :param stats: объект stats.Stats для сбора показателей
+        :param renderer: способ генерации xml-текста из xmlfile.RENDERERS
+        :param seed: целое число, из которого вместе с номером архива
+                     получается начальное состояние генератора случайных
+                     значений архива. При заданном seed архивы повторяются
+                     от запуска к запуску побайтно. По умолчанию для
+                     каждого архива берётся случайное начальное состояние
+        :param compression: способ сжатия xml-файлов из COMPRESSIONS
+        :param level: степень сжатия. По умолчанию используется степень,
+                      принятая для выбранного способа сжатия
         '''
         self.arch_path = path
         self.arch_count = arch_count
         self.xml_count = xml_count
+        self.gen_mode = gen_mode
+        self.tmp_path = tmp_path or path
+        self.buffer_size = buffer_size
+        self.jobs = jobs
+        self.nobjects = nobjects
+        self.stats = stats
+        self.renderer = renderer
+        self.seed = seed
+        self.compression = COMPRESSIONS[compression]
+        self.level = level
+        # Права, с которыми создаются временные xml-файлы в режиме file.
+        # В режиме memory они же записываются в архив, чтобы архивы
+        # получались одинаковыми в обоих режимах.
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = stat.S_IFREG | (0o666 & ~umask)
+
+    def __getstate__(self):
+        # Объект передаётся в процессы пула вместе с задачами, сборщик
+        # показателей там не нужен.
+        state = dict(self.__dict__)
+        state["stats"] = None
+        return state
 
     def make_zip(self, zip_id):
         '''
-        Создаёт zip-архив. Выполняется в отдельном процессе.
+        Создаёт zip-архив. Выполняется в отдельном процессе. Возвращает
+        количество файлов в архиве files и размер архива bytes.
 
         :param zip_id: номер архива, помещаемый в имя архива
         '''
         zip_fpath = os.path.join(self.arch_path,
                                  ArchGen.arch_templ_name.format(n=zip_id))
+        if self.gen_mode == "memory":
+            self.make_zip_in_memory(zip_id, zip_fpath)
+        else:
+            self.make_zip_with_files(zip_id, zip_fpath)
+        print("The {} file was created.".format(zip_fpath))
+        return {"files": self.xml_count, "bytes": os.path.getsize(zip_fpath)}
+
+    def xml_ids(self, zip_id):
+        '''
+        Возвращает номера xml-файлов, помещаемых в заданный архив.
+
+        :param zip_id: номер архива
+        '''
         base_id = (zip_id - 1) * self.xml_count + 1
-        with zipfile.ZipFile(zip_fpath, "w") as zf:
-            for i in range(base_id, base_id + self.xml_count):
-                xml_file = XmlFile(i)
-                xml_fname = ArchGen.xml_templ_name.format(n=i)
-                xml_fpath = os.path.join(self.arch_path, xml_fname)
+        return range(base_id, base_id + self.xml_count)
+
+    def xml_values(self, zip_id):
+        '''
+        Возвращает пары из номера xml-файла заданного архива и случайных
+        значений файла. Значения для всех файлов архива генерируются одним
+        вызовом gen_batch.
+
+        :param zip_id: номер архива
+        '''
+        seed = None if self.seed is None else [self.seed, zip_id]
+        values = gen_batch(self.xml_count, seed, self.nobjects)
+        return list(zip(self.xml_ids(zip_id), values))
+
+    def xml_files(self, zip_id):
+        '''
+        Генерирует xml-файлы заданного архива. Возвращает пары из имени
+        xml-файла и объекта XmlFile.
+
+        :param zip_id: номер архива
+        '''
+        for i, xml_values in self.xml_values(zip_id):
+            yield (ArchGen.xml_templ_name.format(n=i),
+                   XmlFile(i, renderer=self.renderer, values=xml_values))
+
+    def member_date_time(self):
+        '''
+        Возвращает время изменения, записываемое для элемента архива.
+        '''
+        if self.seed is not None:
+            return ArchGen.seed_date_time
+        return time.localtime(time.time())[:6]
+
+    def make_zip_with_files(self, zip_id, zip_fpath):
+        '''
+        Создаёт zip-архив, сохраняя каждый xml-файл во временный файл.
+
+        :param zip_id: номер архива
+        :param zip_fpath: путь к создаваемому архиву
+        '''
+        with zipfile.ZipFile(zip_fpath, "w", self.compression,
+                             compresslevel=self.level) as zf:
+            for xml_fname, xml_file in self.xml_files(zip_id):
+                xml_fpath = os.path.join(self.tmp_path, xml_fname)
                 xml_file.save(xml_fpath)
-                zf.write(xml_fpath, os.path.basename(xml_fpath))
+                if self.seed is not None:
+                    ts = time.mktime(ArchGen.seed_date_time + (0, 0, -1))
+                    os.utime(xml_fpath, (ts, ts))
+                zf.write(xml_fpath, xml_fname)
                 os.unlink(xml_fpath)
+
+    def make_zip_in_memory(self, zip_id, zip_fpath):
+        '''
+        Создаёт zip-архив, записывая сгенерированный текст xml-файлов
+        напрямую в архив. Архив записывается сразу в zip_fpath через буфер
+        размером buffer_size. Метаданные элементов архива совпадают с теми,
+        что записываются в режиме file.
+
+        :param zip_id: номер архива
+        :param zip_fpath: путь к создаваемому архиву
+        '''
+        with open(zip_fpath, "wb", buffering=self.buffer_size) as zip_file:
+            with zipfile.ZipFile(zip_file, "w", self.compression,
+                                 compresslevel=self.level) as zf:
+                for xml_fname, xml_file in self.xml_files(zip_id):
+                    zinfo = zipfile.ZipInfo(xml_fname,
+                                            self.member_date_time())
+                    zinfo.external_attr = self.file_mode << 16
+                    zf.writestr(zinfo, xml_file.xml_content(),
+                                compress_type=zf.compression,
+                                compresslevel=zf.compresslevel)
+
+    def submit_members(self, executor, zip_id, nchunks):
+        '''
+        Генерирует случайные значения xml-файлов архива и отправляет их на
+        генерацию текста и сжатие в пул процессов, разделив на nchunks
+        частей. Возвращает список объектов Future в порядке xml-файлов.
+
+        :param executor: пул процессов
+        :param zip_id: номер архива
+        :param nchunks: количество частей
+        '''
+        members = [(xml_id, self.member_date_time(), xml_values)
+                   for xml_id, xml_values in self.xml_values(zip_id)]
+        size = max(-(-len(members) // nchunks), 1)
+        args = [(members[i:i + size], self.renderer, self.compression,
+                 self.level, self.file_mode)
+                for i in range(0, len(members), size)]
+        if self.stats is None:
+            return [executor.submit(compress_members, *a) for a in args]
+        return [executor.submit(measure_call, compress_members, a)
+                for a in args]
+
+    def write_parallel_zip(self, zip_id, futures):
+        '''
+        Собирает архив из xml-файлов, сжатых в пуле процессов: записывает
+        части архива по порядку, затем центральный каталог, в котором
+        смещения заголовков исправлены на смещения частей, и запись конца
+        центрального каталога. Архив записывается без zip64, поэтому его
+        размер не может превышать 2 ГиБ, а количество файлов - 65534.
+        Возвращает количество файлов в архиве files и размер архива bytes.
+
+        :param zip_id: номер архива
+        :param futures: результаты submit_members для архива
+        '''
+        zip_fpath = os.path.join(self.arch_path,
+                                 ArchGen.arch_templ_name.format(n=zip_id))
+        with open(zip_fpath, "wb") as zip_file:
+            offset = 0
+            count = 0
+            central_dir = []
+            for f in futures:
+                result = f.result()
+                if self.stats is not None:
+                    result, metrics = result
+                    self.stats.add("compress", metrics)
+                central_dir.append(shift_central_dir(result["central_dir"],
+                                                     offset))
+                zip_file.write(result["data"])
+                offset += len(result["data"])
+                count += result["files"]
+                if offset > ZIP64_LIMIT or count >= ZIP_FILECOUNT_LIMIT:
+                    raise zipfile.LargeZipFile(
+                            "The {} archive is too large for the parallel "
+                            "mode".format(zip_fpath))
+            central_dir = b"".join(central_dir)
+            zip_file.write(central_dir)
+            zip_file.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0,
+                                           count, count, len(central_dir),
+                                           offset, 0))
         print("The {} file was created.".format(zip_fpath))
+        return {"files": self.xml_count, "bytes": os.path.getsize(zip_fpath)}
+
+    def zip_all_parallel(self):
+        '''
+        Создаёт архивы по одному в режиме parallel. Xml-файлы каждого архива
+        генерируются и сжимаются в пуле процессов, а архив собирается
+        текущим процессом. Пока собирается архив, сжимаются xml-файлы
+        следующего архива.
+        '''
+        jobs = self.jobs or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        try:
+            pending = None
+            for zip_id in range(1, self.arch_count + 2):
+                futures = None
+                if zip_id <= self.arch_count:
+                    futures = self.submit_members(executor, zip_id, jobs)
+                if pending is not None:
+                    if self.stats is None:
+                        self.write_parallel_zip(*pending)
+                    else:
+                        metrics = measure_call(self.write_parallel_zip,
+                                               pending)[1]
+                        self.stats.add("zip", metrics)
+                pending = (zip_id, futures)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
 
     def zip_all(self):
         '''
         Создаёт заданное количество архивов с заданным числом
         сгенерированнх xml-файлов.
         '''
-        proc = []
-        for j in range(1, self.arch_count + 1):
-            p = multiprocessing.Process(target=self.make_zip, args=(j,))
-            p.start()
-            proc.append(p)
-        wait_for_proc_end(proc)
+        if self.renderer == "jinja":
+            # Шаблон компилируется до запуска пула, и процессы пула
+            # получают его готовым.
+            get_template()
+        if self.gen_mode == "parallel":
+            if self.stats is None:
+                self.zip_all_parallel()
+            else:
+                with self.stats.stage("zip", self.arch_count):
+                    self.zip_all_parallel()
+            return
+        run_tasks(self.make_zip,
+                  [(j,) for j in range(1, self.arch_count + 1)], self.jobs,
+                  self.stats, "zip")
 
 
 class CsvGen(object):
@@ -77,112 +505,411 @@ class CsvGen(object):
     Класс для генерации csv-файлов.
     '''
 
-    def __init__(self, path):
+    csv_modes = ["stream", "extract", "pipeline"]
+    output_formats = ["csv", "columnar"]
+
+    def __init__(self, path, jobs=None, mode="stream", out_path=None,
+                 engine="expat", queue_size=CsvPipeline.default_queue_size,
+                 batch_size=CsvPipeline.default_batch_size, ordered=False,
+                 incremental=False, stats=None, output_format="csv",
+                 shard=None, index=False):
         '''
-        Путь к каталогу, в котором хранятся zip-архивы с xml-файлами.
+        :param path: путь к каталогу, в котором хранятся zip-архивы с
+                     xml-файлами.
+        :param jobs: количество процессов, обрабатывающих архивы. По
+                     умолчанию равно количеству процессоров
+        :param mode: способ обработки архивов: stream - xml-файлы читаются
+                     парсером прямо из архива; extract - архивы сначала
+                     распаковываются в каталоги на диске; pipeline -
+                     конвейер, записывающий строки сразу в итоговые
+                     csv-файлы (см. CsvPipeline)
+        :param out_path: каталог для csv-файлов. По умолчанию совпадает
+                         с path
+        :param engine: имя движка парсинга xml-файлов из
+                       xmlhandler.ENGINES
+        :param queue_size: размер очередей конвейера в режиме pipeline
+        :param batch_size: количество xml-файлов в пакете конвейера в
+                           режиме pipeline
+        :param ordered: упорядочивать строки итоговых csv-файлов по номеру
+                        архива и xml-файла, чтобы повторные запуски давали
+                        одинаковые файлы
+        :param incremental: обрабатывать только новые и изменённые архивы,
+                            сохраняя сведения об обработанных архивах в
+                            манифесте (см. Manifest)
+        :param stats: объект stats.Stats для сбора показателей
+        :param output_format: формат итоговых файлов: csv - levels.csv и
+                              objects.csv; columnar - двоичный
+                              поколоночный формат (см. модуль columnar)
+        :param shard: пара из номера части i и количества частей N.
+                      Обрабатываются только архивы части i (см.
+                      shards.shard_of), итоговые файлы и манифест
+                      сохраняются в каталог shard_{i}_of_{N} каталога
+                      out_path. По умолчанию обрабатываются все архивы
+        :param index: построить после генерации индексы итоговых файлов по
+                      значению id (см. модуль idindex)
         '''
         self.arch_path = path
-        self.handle_archives()
+        self.jobs = jobs
+        self.mode = mode
+        self.out_path = out_path or path
+        self.shard = shard
+        if shard is not None:
+            self.out_path = os.path.join(self.out_path, shard_dirname(*shard))
+        self.engine = engine
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.incremental = incremental
+        self.stats = stats
+        self.output_format = output_format
+        self.index = index
+
+    def __getstate__(self):
+        # Объект передаётся в процессы пула вместе с задачами, сборщик
+        # показателей там не нужен.
+        state = dict(self.__dict__)
+        state["stats"] = None
+        return state
 
-    def handle_archives(self):
+    def output_files(self):
         '''
-        Извлекает xml-файлы из всех архивов.
+        Возвращает имена итоговых файлов для заданного формата.
         '''
-        archives = os.listdir(self.arch_path)
-        proc = []
-        for fname in archives:
-            arch_file_path = os.path.join(self.arch_path, fname)
-            p = multiprocessing.Process(target=self.extract_all,
-                                        args=(arch_file_path,))
-            p.start()
-            proc.append(p)
-        wait_for_proc_end(proc)
+        if self.output_format == "columnar":
+            return list(OUTPUT_FILES)
+        return ["levels.csv", "objects.csv"]
+
+    @contextlib.contextmanager
+    def partial_writer(self, name):
+        '''
+        Контекст записи промежуточных файлов одного архива. Возвращает
+        объект CsvWriter, записывающий строки в файлы levels.{name}.csv и
+        objects.{name}.csv, или в формате columnar - объект ColumnarWriter,
+        значения которого сохраняются в файл columns.{name}.part при выходе
+        из контекста.
+
+        :param name: имя архива или каталога, по которому называются
+                     промежуточные файлы
+        '''
+        if self.output_format == "columnar":
+            writer = ColumnarWriter()
+            yield writer
+            writer.save(os.path.join(self.out_path,
+                                     "columns.{}.part".format(name)))
+            return
+        levels_fpath = os.path.join(self.out_path,
+                                    "levels.{}.csv".format(name))
+        objects_fpath = os.path.join(self.out_path,
+                                     "objects.{}.csv".format(name))
+        with open(levels_fpath, "w") as levels_file, \
+                open(objects_fpath, "w") as objects_file:
+            yield CsvWriter(levels_file, objects_file)
+
+    def list_archives(self):
+        '''
+        Возвращает имена zip-архивов в каталоге с архивами, а при заданной
+        части - только архивы этой части. В режиме ordered архивы
+        упорядочены по номеру.
+        '''
+        archives = [fname for fname in os.listdir(self.arch_path)
+                    if fname.endswith(".zip") and
+                    os.path.isfile(os.path.join(self.arch_path, fname))]
+        if self.shard is not None:
+            index, nshards = self.shard
+            archives = [fname for fname in archives
+                        if shard_of(fname, nshards) == index]
+        if self.ordered:
+            archives.sort(key=natural_key)
+        return archives
+
+    def handle_archives(self, archives):
+        '''
+        Извлекает xml-файлы из заданных архивов.
+
+        :param archives: имена архивов
+        '''
+        run_tasks(self.extract_all,
+                  [(os.path.join(self.arch_path, fname),)
+                   for fname in archives], self.jobs, self.stats, "extract")
 
     def extract_all(self, arch_file_path):
         '''
         Извлекает все xml-файлы из заданного архива. Выполняется в отдельном
-        процессе.
+        процессе. Каталог, оставшийся от прерванного запуска, удаляется.
+        Возвращает количество извлечённых файлов files и их размер bytes.
 
         :param arch_file_path: путь к архиву с xml-файлами.
         '''
         extract_dir_path = "{fname}.d".format(fname=arch_file_path)
+        if os.path.exists(extract_dir_path):
+            shutil.rmtree(extract_dir_path)
         os.mkdir(extract_dir_path)
         with zipfile.ZipFile(arch_file_path, "r") as zf:
             zf.extractall(extract_dir_path)
+            members = [zinfo for zinfo in zf.infolist() if not zinfo.is_dir()]
+        return {"files": len(members),
+                "bytes": sum(zinfo.file_size for zinfo in members)}
 
     def parse_xml_files(self, dirname):
         '''
         Парсит xml-файлы из заданного каталога, чтобы сгенерировать требуемые
         csv-файлы. Выполняется в отдельном процессе. После обработки xml-файл
         удаляется. После обработки всех xml-файлов в каталоге удаляется сам
-        каталог.
+        каталог. Возвращает количество разобранных файлов files, их размер
+        bytes, количество файлов с ошибками errors и количество записанных
+        строк levels_rows и objects_rows.
 
         :param dirname: имя каталога, содержащего xml-файлы заданного формата.
         '''
         dirpath = os.path.join(self.arch_path, dirname)
         for root, dirnames, filenames in os.walk(dirpath):
             break
-        levels_fname = "levels.{dirname}.csv".format(dirname=dirname)
-        objects_fname = "objects.{dirname}.csv".format(dirname=dirname)
-        levels_fpath = os.path.join(self.arch_path, levels_fname)
-        objects_fpath = os.path.join(self.arch_path, objects_fname)
-        parser = xml.sax.make_parser()
-        with open(levels_fpath, "w") as levels_file:
-            with open(objects_fpath, "w") as objects_file:
-                parser.setContentHandler(XmlHandler(levels_file, objects_file))
-                for xml_fname in filenames:
-                    xml_fpath = os.path.join(dirpath, xml_fname)
-                    try:
-                        parser.parse(open(xml_fpath, "r"))
-                    except RequiredAttrError as exc:
-                        print("File {f}: {msg}".format(
-                                f=xml_fpath, msg=exc))
-                    os.unlink(xml_fpath)
+        if self.ordered:
+            filenames.sort(key=natural_key)
+        nbytes = 0
+        errors = 0
+        with self.partial_writer(dirname) as writer:
+            parser = make_engine(self.engine, writer)
+            for xml_fname in filenames:
+                xml_fpath = os.path.join(dirpath, xml_fname)
+                nbytes += os.path.getsize(xml_fpath)
+                try:
+                    with open(xml_fpath, "rb") as xml_file:
+                        parser.parse(xml_file)
+                except RequiredAttrError as exc:
+                    print("File {f}: {msg}".format(f=xml_fpath, msg=exc))
+                    errors += 1
+                os.unlink(xml_fpath)
         try:
             os.rmdir(dirpath)
         except OSError as exc:
             print("Directory {d} couldn't be removed: {exc}".format(d=dirpath,
                                                                     exc=exc))
+        return {"files": len(filenames), "bytes": nbytes, "errors": errors,
+                "levels_rows": writer.levels_rows,
+                "objects_rows": writer.objects_rows}
+
+    def parse_archive(self, arch_fname):
+        '''
+        Парсит xml-файлы заданного архива, читая их прямо из архива, чтобы
+        сгенерировать требуемые csv-файлы. Выполняется в отдельном процессе.
+        Архив не изменяется, промежуточные файлы и каталоги не создаются.
+        Возвращает количество разобранных файлов files, их размер bytes,
+        количество файлов с ошибками errors и количество записанных строк
+        levels_rows и objects_rows.
+
+        :param arch_fname: имя zip-архива с xml-файлами заданного формата.
+        '''
+        arch_fpath = os.path.join(self.arch_path, arch_fname)
+        with zipfile.ZipFile(arch_fpath, "r") as zf, \
+                self.partial_writer(arch_fname) as writer:
+            parser = make_engine(self.engine, writer)
+            members = [zinfo for zinfo in zf.infolist() if not zinfo.is_dir()]
+            errors = 0
+            for zinfo in members:
+                with zf.open(zinfo) as xml_file:
+                    try:
+                        parser.parse(xml_file)
+                    except RequiredAttrError as exc:
+                        print("File {a}:{f}: {msg}".format(
+                                a=arch_fpath, f=zinfo.filename, msg=exc))
+                        errors += 1
+        return {"files": len(members),
+                "bytes": sum(zinfo.file_size for zinfo in members),
+                "errors": errors, "levels_rows": writer.levels_rows,
+                "objects_rows": writer.objects_rows}
+
+    def partial_files(self, name):
+        '''
+        Возвращает имена промежуточных csv-файлов заданного набора данных.
+
+        :param name: часть имени csv-файла, по которому определяется требуемый
+                     набор данных.
+        '''
+        csv_fname = "{}.csv".format(name)
+        prefix = "{}.".format(name)
+        return [fname for fname in os.listdir(self.out_path)
+                if fname.startswith(prefix) and
+                fname.endswith(".csv") and fname != csv_fname]
 
-    def join_csv_files(self, name):
+    def join_csv_files(self, name, append=False):
         '''
         Объединяет csv-файлы, которые после удаляются, в один общий.
-        Выполняется в отдельном процессе.
+        Выполняется в отдельном процессе. Файлы копируются средствами ядра
+        (см. append_file). В режиме ordered файлы объединяются в порядке
+        номеров архивов. Возвращает количество объединённых файлов files и
+        их размер bytes.
 
         :param name: часть имени csv-файла, по которому определяется требуемый
                      набор данных.
+        :param append: дописать данные в существующий общий файл.
         '''
-        csv_templ_name = os.path.join(self.arch_path,
-                                      "{}.*.csv".format(name))
-        csv_fpath = os.path.join(self.arch_path,
-                                 "{}.csv".format(name))
-        with open(csv_fpath, "w") as csv_file:
-            for fpath in glob(csv_templ_name):
-                with open(fpath, "r") as f:
-                    csv_file.write(f.read())
+        part_fnames = self.partial_files(name)
+        if self.ordered:
+            part_fnames.sort(key=natural_key)
+        csv_fpath = os.path.join(self.out_path, "{}.csv".format(name))
+        file_mode = "r+b" if append and os.path.exists(csv_fpath) else "wb"
+        with open(csv_fpath, file_mode, buffering=0) as csv_file:
+            start = csv_file.seek(0, os.SEEK_END)
+            for fname in part_fnames:
+                fpath = os.path.join(self.out_path, fname)
+                append_file(csv_file, fpath)
                 os.unlink(fpath)
+            nbytes = csv_file.tell() - start
         print("The {} file was created.".format(csv_fpath))
+        return {"files": len(part_fnames), "bytes": nbytes}
+
+    def partial_columns_files(self):
+        '''
+        Возвращает имена промежуточных файлов формата columnar.
+        '''
+        return [fname for fname in os.listdir(self.out_path)
+                if fname.startswith("columns.") and fname.endswith(".part")]
+
+    def join_columns(self, append=False):
+        '''
+        Дописывает значения из промежуточных файлов формата columnar, которые
+        после удаляются, в итоговые файлы (см. columnar.ColumnarStore).
+        В режиме ordered файлы объединяются в порядке номеров архивов.
+        Возвращает количество объединённых файлов files и количество
+        записанных байт колонок bytes.
+
+        :param append: дописать значения в существующие итоговые файлы.
+        '''
+        part_fnames = self.partial_columns_files()
+        if self.ordered:
+            part_fnames.sort(key=natural_key)
+        nbytes = 0
+        with ColumnarStore(self.out_path, append) as store:
+            for fname in part_fnames:
+                fpath = os.path.join(self.out_path, fname)
+                nbytes += store.append(load_chunk(fpath))
+                os.unlink(fpath)
+        print("The columnar files were created in {}.".format(self.out_path))
+        return {"files": len(part_fnames), "bytes": nbytes}
+
+    def process_archives(self, archives, append=False):
+        '''
+        Запускает обработку xml-файлов для каждого из заданных архивов (в
+        режиме extract - после распаковки архивов в каталоги), а затем
+        объединяет созданные csv-файлы в два общих по виду требуемого
+        набора данных. В режиме pipeline итоговые csv-файлы формируются
+        конвейером за один проход. Возвращает словарь, в котором для каждого
+        архива указано количество записанных строк.
+
+        :param archives: имена обрабатываемых архивов
+        :param append: дописать строки в существующие итоговые csv-файлы
+        '''
+        if self.mode == "pipeline":
+            return CsvPipeline(self.arch_path, archives, self.out_path,
+                               self.engine, self.jobs, self.queue_size,
+                               self.batch_size, self.ordered, append,
+                               self.stats, self.output_format).run()
+        if self.mode == "stream":
+            results = run_tasks(self.parse_archive,
+                                [(fname,) for fname in archives], self.jobs,
+                                self.stats, "parse")
+        else:
+            self.handle_archives(archives)
+            results = run_tasks(self.parse_xml_files,
+                                [("{}.d".format(fname),)
+                                 for fname in archives],
+                                self.jobs, self.stats, "parse")
+        if self.output_format == "columnar":
+            run_tasks(self.join_columns, [(append,)], 1, self.stats, "join")
+        else:
+            run_tasks(self.join_csv_files,
+                      [("levels", append), ("objects", append)], self.jobs,
+                      self.stats, "join")
+        return dict(zip(archives, results))
 
     def gen_csv_files(self):
         '''
-        Запускает обработку xml-файлов для каждого каталога с xml-файлами, а
-        затем объединяет созданные csv-файлы в два общих по виду требуемого
-        набора данных.
+        Формирует итоговые csv-файлы по всем архивам каталога, а в режиме
+        incremental - только по новым и изменённым архивам. Для части
+        архивов всегда используется режим incremental: манифест части нужен
+        для проверки при объединении частей (см. shards.ShardMerge).
         '''
-        for root, dirnames, filenames in os.walk(self.arch_path):
-            break
-        proc = []
-        for dirname in dirnames:
-            p = multiprocessing.Process(target=self.parse_xml_files,
-                                        args=(dirname,))
-            p.start()
-            proc.append(p)
-        wait_for_proc_end(proc)
-
-        proc.append(multiprocessing.Process(target=self.join_csv_files,
-                                            args=("levels",)))
-        proc.append(multiprocessing.Process(target=self.join_csv_files,
-                                            args=("objects",)))
-        for p in proc:
-            p.start()
-        wait_for_proc_end(proc)
+        if self.shard is not None:
+            os.makedirs(self.out_path, exist_ok=True)
+        if self.incremental or self.shard is not None:
+            self.gen_csv_files_incremental()
+        else:
+            self.process_archives(self.list_archives())
+        if self.index:
+            self.build_indexes()
+
+    def build_indexes(self):
+        '''
+        Строит индексы итоговых файлов levels и objects по значению id.
+        '''
+        build_indexes(self.out_path, self.output_format, self.jobs,
+                      self.stats)
+
+    def gen_csv_files_incremental(self):
+        '''
+        Обрабатывает архивы, которых нет в манифесте. Строки новых архивов
+        дописываются в итоговые csv-файлы. Если какой-либо архив изменился
+        или был удалён, или итоговые файлы повреждены, итоговые файлы
+        формируются заново по всем архивам. Строки, дописанные прерванным
+        запуском, отбрасываются, поэтому после сбоя достаточно запустить
+        обработку повторно.
+        '''
+        manifest = Manifest(self.out_path)
+        manifest.load()
+        archives = self.list_archives()
+        stats = dict((fname, Manifest.archive_stat(
+                                os.path.join(self.arch_path, fname)))
+                     for fname in archives)
+        candidates = [fname for fname in archives
+                      if not manifest.is_unchanged(fname, stats[fname])]
+        hashes = dict(zip(candidates, run_tasks(
+                                    file_hash,
+                                    [(os.path.join(self.arch_path, fname),)
+                                     for fname in candidates], self.jobs,
+                                    self.stats, "hash")))
+        new_archives = []
+        rebuild = (not manifest.outputs_valid() or
+                   set(manifest.outputs) != set(self.output_files()))
+        for fname in archives:
+            record = manifest.archives.get(fname)
+            if fname in hashes:
+                stats[fname]["sha256"] = hashes[fname]
+            else:
+                stats[fname]["sha256"] = record["sha256"]
+            if record is None:
+                new_archives.append(fname)
+            elif record["sha256"] != stats[fname]["sha256"]:
+                rebuild = True
+            else:
+                # Архив не изменился, но могло измениться время изменения.
+                record.update(stats[fname])
+        if set(manifest.archives) - set(archives):
+            rebuild = True
+
+        for fname in (self.partial_files("levels") +
+                      self.partial_files("objects") +
+                      self.partial_columns_files()):
+            os.unlink(os.path.join(self.out_path, fname))
+        if rebuild:
+            print("Rebuilding csv files from {} archives.".format(
+                    len(archives)))
+            manifest.archives = {}
+            new_archives = archives
+        else:
+            # Строки, дописанные прерванным запуском, отбрасываются и в том
+            # случае, если новых архивов нет.
+            manifest.truncate_outputs()
+            if not new_archives:
+                print("No new archives found.")
+                manifest.save()
+                return
+            print("Processing {} new archives.".format(len(new_archives)))
+        counts = self.process_archives(new_archives, append=not rebuild)
+        for fname in new_archives:
+            record = dict(stats[fname])
+            record["levels_rows"] = counts[fname]["levels_rows"]
+            record["objects_rows"] = counts[fname]["objects_rows"]
+            manifest.archives[fname] = record
+        manifest.update_outputs(self.output_files())
+        manifest.save()
@@ -0,0 +1,245 @@
+'''
+Модуль содержит функции построения индекса итоговых файлов по значению id
+и класс для поиска строк по индексу.
+
+Индекс хранится рядом с файлом данных в файле {имя файла данных}.idx:
+заголовок из сигнатуры INDEX_MAGIC и размера файла данных, для которого
+построен индекс, и записи из трёх целых чисел int64 (little-endian):
+значение id, начало группы строк с этим id и количество строк в группе.
+Для csv-файлов начало группы - смещение в байтах, для колонки id формата
+columnar - номер строки. Записи упорядочены по id, поэтому индекс
+отображается в память и используется для двоичного поиска без разбора.
+Значения id должны быть целыми числами.
+'''
+
+
+import os
+import sys
+import mmap
+import bisect
+from array import array
+from columnar import column_fname, from_le_bytes, to_le_bytes, open_columns
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+INDEX_MAGIC = b"CSVIDX01"
+
+# Файлы данных, по которым строится индекс, для каждого формата.
+DATA_FILES = {
+    "csv": {"levels": "levels.csv", "objects": "objects.csv"},
+    "columnar": {"levels": column_fname("levels", "id"),
+                 "objects": column_fname("objects", "id")},
+}
+
+
+class IdIndexError(Exception):
+    pass
+
+
+def index_fpath(data_fpath):
+    '''
+    Возвращает путь к индексу файла данных.
+
+    :param data_fpath: путь к файлу данных
+    '''
+    return "{}.idx".format(data_fpath)
+
+
+def csv_groups(data_fpath):
+    '''
+    Возвращает группы подряд идущих строк csv-файла с одинаковым id в виде
+    кортежей из значения id, смещения первой строки в байтах и количества
+    строк.
+
+    :param data_fpath: путь к csv-файлу, в каждой строке которого первым
+                       полем записано значение id в кавычках
+    '''
+    groups = []
+    offset = 0
+    with open(data_fpath, "rb") as f:
+        for line in f:
+            value_id = int(line[1:line.index(b'"', 1)])
+            if groups and groups[-1][0] == value_id:
+                groups[-1][2] += 1
+            else:
+                groups.append([value_id, offset, 1])
+            offset += len(line)
+    return groups
+
+
+def column_groups(data_fpath):
+    '''
+    Возвращает группы подряд идущих строк колонки id формата columnar с
+    одинаковым значением в виде кортежей из значения id, номера первой
+    строки и количества строк. При наличии NumPy группы выделяются
+    векторно.
+
+    :param data_fpath: путь к файлу колонки id
+    '''
+    with open(data_fpath, "rb") as f:
+        data = f.read()
+    if numpy is not None:
+        ids = numpy.frombuffer(data, dtype="<i8")
+        if not len(ids):
+            return []
+        starts = numpy.flatnonzero(numpy.diff(ids)) + 1
+        starts = numpy.concatenate(([0], starts))
+        rows = numpy.diff(numpy.concatenate((starts, [len(ids)])))
+        return list(zip(ids[starts].tolist(), starts.tolist(),
+                        rows.tolist()))
+    groups = []
+    for row, value_id in enumerate(from_le_bytes("q", data)):
+        if groups and groups[-1][0] == value_id:
+            groups[-1][2] += 1
+        else:
+            groups.append([value_id, row, 1])
+    return groups
+
+
+def build_index(data_fpath, output_format):
+    '''
+    Строит индекс файла данных и атомарно сохраняет его. Выполняется в
+    отдельном процессе. Возвращает количество записей индекса files и
+    размер проиндексированного файла bytes.
+
+    :param data_fpath: путь к файлу данных (см. DATA_FILES)
+    :param output_format: формат файла данных: csv или columnar
+    '''
+    data_size = os.path.getsize(data_fpath)
+    if output_format == "columnar":
+        groups = column_groups(data_fpath)
+    else:
+        groups = csv_groups(data_fpath)
+    groups.sort()
+    records = array("q")
+    for group in groups:
+        records.extend(group)
+    header = array("q", [data_size])
+    idx_fpath = index_fpath(data_fpath)
+    tmp_fpath = "{}.tmp".format(idx_fpath)
+    with open(tmp_fpath, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(to_le_bytes(header))
+        f.write(to_le_bytes(records))
+    os.replace(tmp_fpath, idx_fpath)
+    return {"files": len(groups), "bytes": data_size}
+
+
+class IdIndex(object):
+    '''
+    Индекс одного файла данных, отображённый в память вместе с файлом
+    данных. Поиск выполняется двоичным поиском по записям индекса.
+    Индекс, построенный для файла данных другого размера, считается
+    устаревшим и приводит к IdIndexError.
+    '''
+
+    header_size = len(INDEX_MAGIC) + 8
+
+    def __init__(self, data_fpath):
+        '''
+        :param data_fpath: путь к файлу данных
+        '''
+        idx_fpath = index_fpath(data_fpath)
+        if not os.path.exists(idx_fpath):
+            raise IdIndexError("The {} index doesn't exist, run the csv "
+                               "command with --index".format(idx_fpath))
+        self.data = self.map_file(data_fpath)
+        self.index = self.map_file(idx_fpath)
+        if (bytes(self.index[:len(INDEX_MAGIC)]) != INDEX_MAGIC or
+                from_le_bytes("q", self.index[len(INDEX_MAGIC):
+                                              self.header_size])[0] !=
+                len(self.data)):
+            raise IdIndexError("The {} index is stale, run the csv command "
+                               "with --index".format(idx_fpath))
+        if sys.byteorder == "little":
+            self.records = memoryview(self.index)[self.header_size:].cast("q")
+        else:
+            self.records = from_le_bytes("q", self.index[self.header_size:])
+        # Значения id записей: каждое третье число.
+        self.ids = self.records[0::3]
+
+    @staticmethod
+    def map_file(fpath):
+        '''
+        Отображает файл в память только для чтения. Пустой файл
+        отображается пустой строкой байтов.
+
+        :param fpath: путь к файлу
+        '''
+        with open(fpath, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def find(self, value_id):
+        '''
+        Возвращает список пар из начала группы строк с заданным id и
+        количества строк в группе.
+
+        :param value_id: значение id
+        '''
+        lo = bisect.bisect_left(self.ids, value_id)
+        hi = bisect.bisect_right(self.ids, value_id, lo)
+        return [(self.records[i * 3 + 1], self.records[i * 3 + 2])
+                for i in range(lo, hi)]
+
+    def csv_rows(self, value_id):
+        '''
+        Возвращает строки csv-файла данных с заданным id.
+
+        :param value_id: значение id
+        '''
+        rows = []
+        for start, count in self.find(value_id):
+            end = start
+            for i in range(count):
+                end = self.data.find(b"\n", end) + 1
+            rows.extend(bytes(self.data[start:end]).decode().splitlines())
+        return rows
+
+
+class Lookup(object):
+    '''
+    Поиск строк levels и objects по значению id в итоговых файлах с
+    помощью индексов, построенных build_index. Строки возвращаются в
+    формате csv независимо от формата итоговых файлов.
+    '''
+
+    def __init__(self, out_path, output_format="csv"):
+        '''
+        :param out_path: каталог с итоговыми файлами и индексами
+        :param output_format: формат итоговых файлов: csv или columnar
+        '''
+        self.output_format = output_format
+        self.indexes = dict(
+            (dataset, IdIndex(os.path.join(out_path, fname)))
+            for dataset, fname in DATA_FILES[output_format].items())
+        if output_format == "columnar":
+            self.columns, self.names = open_columns(out_path)
+
+    def lookup(self, value_id):
+        '''
+        Возвращает словарь со списками строк levels и objects с заданным
+        id.
+
+        :param value_id: значение id
+        '''
+        if self.output_format == "csv":
+            return dict((dataset, index.csv_rows(value_id))
+                        for dataset, index in self.indexes.items())
+        levels = []
+        for start, count in self.indexes["levels"].find(value_id):
+            levels.extend('"{i}",{level}'.format(i=value_id, level=level)
+                          for level in self.columns["levels", "level"][
+                              start:start + count])
+        objects = []
+        for start, count in self.indexes["objects"].find(value_id):
+            objects.extend('"{i}","{name}"'.format(i=value_id,
+                                                   name=self.names[code])
+                           for code in self.columns["objects", "name"][
+                               start:start + count])
+        return {"levels": levels, "objects": objects}
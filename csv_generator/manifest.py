@@ -0,0 +1,126 @@
+'''
+Модуль содержит класс манифеста обработанных zip-архивов.
+'''
+
+
+import os
+import json
+import hashlib
+
+
+def file_hash(fpath):
+    '''
+    Возвращает sha256 содержимого файла в шестнадцатеричном виде.
+
+    :param fpath: путь к файлу
+    '''
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    '''
+    Манифест хранит для каждого обработанного архива его размер, время
+    изменения, хеш содержимого и количество добавленных им строк в
+    csv-файлы, а также размеры итоговых csv-файлов после последнего
+    успешного запуска. Манифест сохраняется в каталоге csv-файлов
+    атомарно и только после того, как итоговые файлы записаны, поэтому
+    он всегда описывает согласованное состояние.
+    '''
+
+    fname = "manifest.json"
+
+    def __init__(self, out_path):
+        '''
+        :param out_path: каталог с итоговыми csv-файлами
+        '''
+        self.out_path = out_path
+        self.fpath = os.path.join(out_path, Manifest.fname)
+        # Сведения об архивах по именам архивов.
+        self.archives = {}
+        # Размеры итоговых файлов по их именам.
+        self.outputs = {}
+
+    def load(self):
+        '''
+        Загружает манифест, если он существует.
+        '''
+        if not os.path.exists(self.fpath):
+            return
+        with open(self.fpath, "r") as f:
+            data = json.load(f)
+        self.archives = data["archives"]
+        self.outputs = data["outputs"]
+
+    def save(self):
+        '''
+        Сбрасывает на диск итоговые файлы и атомарно сохраняет манифест.
+        '''
+        for fname in self.outputs:
+            with open(os.path.join(self.out_path, fname), "rb") as f:
+                os.fsync(f.fileno())
+        tmp_fpath = "{}.tmp".format(self.fpath)
+        with open(tmp_fpath, "w") as f:
+            json.dump({"archives": self.archives, "outputs": self.outputs},
+                      f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fpath, self.fpath)
+
+    @staticmethod
+    def archive_stat(arch_fpath):
+        '''
+        Возвращает размер и время изменения архива.
+
+        :param arch_fpath: путь к архиву
+        '''
+        st = os.stat(arch_fpath)
+        return {"size": st.st_size, "mtime": st.st_mtime}
+
+    def is_unchanged(self, arch_fname, arch_stat):
+        '''
+        Проверяет, что размер и время изменения архива совпадают с
+        записанными в манифест.
+
+        :param arch_fname: имя архива
+        :param arch_stat: результат archive_stat для архива
+        '''
+        record = self.archives.get(arch_fname)
+        return (record is not None and
+                record["size"] == arch_stat["size"] and
+                record["mtime"] == arch_stat["mtime"])
+
+    def outputs_valid(self):
+        '''
+        Проверяет, что итоговые файлы записаны в манифест и не короче
+        записанных размеров. Более длинные файлы остаются после прерванного
+        дописывания и восстанавливаются truncate_outputs.
+        '''
+        if not self.outputs:
+            return False
+        for fname, size in self.outputs.items():
+            fpath = os.path.join(self.out_path, fname)
+            if not os.path.exists(fpath) or os.path.getsize(fpath) < size:
+                return False
+        return True
+
+    def truncate_outputs(self):
+        '''
+        Обрезает итоговые файлы до размеров, записанных в манифест,
+        отбрасывая строки, дописанные прерванным запуском.
+        '''
+        for fname, size in self.outputs.items():
+            os.truncate(os.path.join(self.out_path, fname), size)
+
+    def update_outputs(self, fnames):
+        '''
+        Записывает в манифест текущие размеры итоговых файлов.
+
+        :param fnames: имена итоговых файлов
+        '''
+        self.outputs = dict(
+            (fname, os.path.getsize(os.path.join(self.out_path, fname)))
+            for fname in fnames)
@@ -0,0 +1,327 @@
+'''
+Модуль содержит класс для конвейерной генерации csv-файлов из zip-архивов.
+'''
+
+
+import io
+import os
+import time
+import zipfile
+import traceback
+import contextlib
+import multiprocessing
+from queue import Empty
+from xmlhandler import CsvWriter, RequiredAttrError, make_engine
+from columnar import ColumnarWriter, ColumnarStore
+from stats import peak_rss
+
+
+def stage_metrics(wall, cpu, **counters):
+    '''
+    Возвращает показатели стадии конвейера, выполнявшейся в текущем
+    процессе (см. stats.measure_call).
+
+    :param wall: время начала стадии (time.perf_counter)
+    :param cpu: процессорное время на начало стадии (time.process_time)
+    :param counters: счётчики стадии
+    '''
+    metrics = {
+        "pid": os.getpid(),
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "max_rss_kb": peak_rss(),
+    }
+    metrics.update(counters)
+    return metrics
+
+
+def read_archives(arch_path, archives, task_queue, result_queue,
+                  batch_size, nworkers, window=None):
+    '''
+    Стадия чтения. Читает xml-файлы из архивов и передаёт их пакетами
+    по batch_size файлов в очередь задач. Пакеты нумеруются по порядку.
+    Выполняется в отдельном процессе. По окончании передаёт в очередь
+    результатов показатели стадии.
+
+    :param arch_path: путь к каталогу с архивами
+    :param archives: имена обрабатываемых архивов
+    :param task_queue: очередь пакетов xml-файлов для разбора
+    :param result_queue: очередь результатов, в которую передаются ошибка
+                         и показатели стадии
+    :param batch_size: количество xml-файлов в пакете
+    :param nworkers: количество процессов разбора
+    :param window: семафор, ограничивающий количество пакетов, переданных
+                   в очередь задач, но ещё не записанных стадией записи
+    '''
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    seq = 0
+    nfiles = 0
+    nbytes = 0
+    try:
+        for arch_fname in archives:
+            arch_fpath = os.path.join(arch_path, arch_fname)
+            with zipfile.ZipFile(arch_fpath, "r") as zf:
+                batch = []
+                for zinfo in zf.infolist():
+                    if zinfo.is_dir():
+                        continue
+                    batch.append((zinfo.filename, zf.read(zinfo)))
+                    nfiles += 1
+                    nbytes += zinfo.file_size
+                    if len(batch) == batch_size:
+                        if window is not None:
+                            window.acquire()
+                        task_queue.put((seq, arch_fpath, batch))
+                        seq += 1
+                        batch = []
+                if batch:
+                    if window is not None:
+                        window.acquire()
+                    task_queue.put((seq, arch_fpath, batch))
+                    seq += 1
+    except Exception:
+        result_queue.put(("error", traceback.format_exc()))
+    finally:
+        for i in range(nworkers):
+            task_queue.put(None)
+        result_queue.put(("stats", "read", stage_metrics(
+                            wall, cpu, files=nfiles, bytes=nbytes)))
+        result_queue.put(None)
+
+
+def parse_batches(engine, output_format, task_queue, result_queue):
+    '''
+    Стадия разбора. Разбирает пакеты xml-файлов и передаёт полученные
+    строки csv-файлов (в формате columnar - значения колонок) в очередь
+    результатов вместе со счётчиками пакета. Выполняется в отдельном
+    процессе. По окончании передаёт в очередь результатов показатели
+    стадии.
+
+    :param engine: имя движка парсинга xml-файлов
+    :param output_format: формат итоговых файлов (csv или columnar)
+    :param task_queue: очередь пакетов xml-файлов для разбора
+    :param result_queue: очередь результатов
+    '''
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    totals = dict(files=0, bytes=0, errors=0, levels_rows=0, objects_rows=0)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, arch_fpath, batch = task
+            if output_format == "columnar":
+                writer = ColumnarWriter()
+            else:
+                levels_buf = io.StringIO()
+                objects_buf = io.StringIO()
+                writer = CsvWriter(levels_buf, objects_buf)
+            parser = make_engine(engine, writer)
+            counters = dict(files=len(batch), errors=0,
+                            bytes=sum(len(data) for xml_fname, data in batch))
+            for xml_fname, data in batch:
+                try:
+                    parser.parse(io.BytesIO(data))
+                except RequiredAttrError as exc:
+                    print("File {a}:{f}: {msg}".format(
+                            a=arch_fpath, f=xml_fname, msg=exc))
+                    counters["errors"] += 1
+            counters["levels_rows"] = writer.levels_rows
+            counters["objects_rows"] = writer.objects_rows
+            for name in totals:
+                totals[name] += counters[name]
+            if output_format == "columnar":
+                rows = writer.chunk()
+            else:
+                rows = (levels_buf.getvalue(), objects_buf.getvalue())
+            result_queue.put(("rows", seq, os.path.basename(arch_fpath),
+                              rows, counters))
+    except Exception:
+        result_queue.put(("error", traceback.format_exc()))
+    finally:
+        result_queue.put(("stats", "parse",
+                          stage_metrics(wall, cpu, **totals)))
+        result_queue.put(None)
+
+
+class PipelineError(Exception):
+    pass
+
+
+class CsvPipeline(object):
+    '''
+    Генерирует csv-файлы за один проход: стадия чтения извлекает xml-файлы
+    из архивов, несколько процессов разбирают их, а стадия записи
+    (текущий процесс) сразу дописывает полученные строки в итоговые
+    csv-файлы. Стадии связаны очередями ограниченного размера, поэтому
+    объём данных в памяти не превышает примерно
+    2 * queue_size * batch_size xml-файлов.
+
+    В режиме ordered строки записываются в порядке пакетов: пакеты,
+    разобранные раньше предыдущих, ждут своей очереди в памяти стадии
+    записи. Чтобы их количество не росло, стадия чтения передаёт новый
+    пакет, только если прочитанных, но ещё не записанных пакетов меньше
+    queue_size, поэтому в этом режиме в памяти находится не больше
+    queue_size пакетов.
+    '''
+
+    default_queue_size = 64
+    default_batch_size = 100
+
+    def __init__(self, arch_path, archives, out_path, engine, jobs=None,
+                 queue_size=default_queue_size,
+                 batch_size=default_batch_size, ordered=False, append=False,
+                 stats=None, output_format="csv"):
+        '''
+        :param arch_path: путь к каталогу с архивами
+        :param archives: имена обрабатываемых архивов
+        :param out_path: каталог для csv-файлов
+        :param engine: имя движка парсинга xml-файлов
+        :param jobs: количество процессов разбора. По умолчанию равно
+                     количеству процессоров
+        :param queue_size: максимальное количество пакетов в каждой
+                           из очередей
+        :param batch_size: количество xml-файлов в пакете
+        :param ordered: записывать строки в порядке архивов из archives
+        :param append: дописывать строки в существующие csv-файлы
+        :param stats: объект stats.Stats для сбора показателей стадий
+        :param output_format: формат итоговых файлов: csv или columnar
+        '''
+        self.arch_path = arch_path
+        self.archives = archives
+        self.out_path = out_path
+        self.engine = engine
+        self.jobs = jobs or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.append = append
+        self.stats = stats
+        self.output_format = output_format
+
+    def run(self):
+        '''
+        Запускает конвейер и дожидается его завершения. Ошибка в любой из
+        стадий прерывает работу конвейера и приводит к PipelineError.
+        Возвращает словарь, в котором для каждого архива указано количество
+        записанных строк levels_rows и objects_rows.
+        '''
+        task_queue = multiprocessing.Queue(self.queue_size)
+        result_queue = multiprocessing.Queue(self.queue_size)
+        window = None
+        if self.ordered:
+            window = multiprocessing.BoundedSemaphore(self.queue_size)
+        reader = multiprocessing.Process(
+                    target=read_archives,
+                    args=(self.arch_path, self.archives, task_queue,
+                          result_queue, self.batch_size, self.jobs, window))
+        workers = [multiprocessing.Process(
+                        target=parse_batches,
+                        args=(self.engine, self.output_format, task_queue,
+                              result_queue))
+                   for i in range(self.jobs)]
+        procs = [reader] + workers
+        for p in procs:
+            p.start()
+        try:
+            with self.open_output() as write:
+                if self.stats is None:
+                    counts = self.write_results(result_queue, procs, write,
+                                                window)
+                else:
+                    with self.stats.stage("write"):
+                        counts = self.write_results(result_queue, procs,
+                                                    write, window)
+        except BaseException:
+            for p in procs:
+                p.terminate()
+            raise
+        finally:
+            for p in procs:
+                p.join()
+        if self.output_format == "columnar":
+            print("The columnar files were created in {}.".format(
+                    self.out_path))
+        else:
+            print("The {} file was created.".format(
+                    os.path.join(self.out_path, "levels.csv")))
+            print("The {} file was created.".format(
+                    os.path.join(self.out_path, "objects.csv")))
+        return counts
+
+    @contextlib.contextmanager
+    def open_output(self):
+        '''
+        Контекст записи итоговых файлов. Возвращает функцию, которая
+        дописывает в итоговые файлы данные одного пакета, полученные от
+        стадии разбора.
+        '''
+        if self.output_format == "columnar":
+            with ColumnarStore(self.out_path, self.append) as store:
+                yield store.append
+            return
+        levels_fpath = os.path.join(self.out_path, "levels.csv")
+        objects_fpath = os.path.join(self.out_path, "objects.csv")
+        file_mode = "a" if self.append else "w"
+        with open(levels_fpath, file_mode) as levels_file, \
+                open(objects_fpath, file_mode) as objects_file:
+            def write(rows):
+                levels_file.write(rows[0])
+                objects_file.write(rows[1])
+            yield write
+
+    def write_results(self, result_queue, procs, write, window=None):
+        '''
+        Стадия записи. Дописывает строки из очереди результатов в итоговые
+        файлы, пока не завершатся все процессы разбора. Возвращает
+        количество записанных строк по архивам.
+
+        :param result_queue: очередь результатов
+        :param procs: процессы конвейера
+        :param write: функция записи данных пакета (см. open_output)
+        :param window: семафор стадии чтения (см. read_archives), который
+                       освобождается после записи каждого пакета
+        '''
+        # Стадию чтения и каждый процесс разбора завершает None.
+        running = self.jobs + 1
+        # Пакеты, ожидающие записи в режиме ordered, по номерам.
+        pending = {}
+        next_seq = 0
+        counts = dict((arch_fname, {"levels_rows": 0, "objects_rows": 0})
+                      for arch_fname in self.archives)
+        while running:
+            try:
+                result = result_queue.get(timeout=1)
+            except Empty:
+                for p in procs:
+                    if p.exitcode:
+                        raise PipelineError(
+                            "The {name} process exited with code "
+                            "{code}".format(name=p.name, code=p.exitcode))
+                continue
+            if result is None:
+                running -= 1
+                continue
+            if result[0] == "error":
+                raise PipelineError(result[1])
+            if result[0] == "stats":
+                if self.stats is not None:
+                    self.stats.add(result[1], result[2])
+                continue
+            seq, arch_fname, rows, counters = result[1:]
+            arch_counts = counts[arch_fname]
+            arch_counts["levels_rows"] += counters["levels_rows"]
+            arch_counts["objects_rows"] += counters["objects_rows"]
+            if self.stats is not None:
+                self.stats.add("write", counters)
+            if not self.ordered:
+                write(rows)
+                continue
+            pending[seq] = rows
+            while next_seq in pending:
+                write(pending.pop(next_seq))
+                next_seq += 1
+                window.release()
+        return counts
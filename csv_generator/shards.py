@@ -0,0 +1,281 @@
+'''
+Модуль содержит функции распределения архивов по частям (шардам) и класс
+для объединения итоговых файлов частей.
+
+Архив относится к части crc32(имя архива) % N, поэтому распределение не
+зависит от узла, порядка архивов и версии Python. Каждая часть сохраняет
+итоговые файлы и манифест (см. manifest.Manifest) в собственный каталог
+shard_{i}_of_{N} каталога итоговых файлов.
+'''
+
+
+import os
+import re
+import json
+import zlib
+import argparse
+from array import array
+from manifest import Manifest
+from columnar import ColumnarStore, COLUMNS, OUTPUT_FILES, DICT_FNAME, \
+    column_fname
+
+
+SHARD_DIR_RE = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+# Количество строк колонки, перекодируемых за один раз при объединении
+# частей в формате columnar.
+MERGE_CHUNK_ROWS = 1024 * 1024
+
+
+class ShardError(Exception):
+    pass
+
+
+def shard_of(arch_fname, nshards):
+    '''
+    Возвращает номер части, к которой относится архив.
+
+    :param arch_fname: имя архива
+    :param nshards: количество частей
+    '''
+    return zlib.crc32(arch_fname.encode("utf-8")) % nshards
+
+
+def shard_dirname(index, nshards):
+    '''
+    Возвращает имя каталога итоговых файлов части.
+
+    :param index: номер части от 0 до nshards - 1
+    :param nshards: количество частей
+    '''
+    return "shard_{}_of_{}".format(index, nshards)
+
+
+def parse_shard(value):
+    '''
+    Разбирает значение параметра shard вида i/N.
+
+    :param value: строка вида i/N, где 0 <= i < N
+    '''
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "'{}' is not of the form i/N".format(value))
+    index, nshards = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < nshards:
+        raise argparse.ArgumentTypeError(
+            "the shard index must be in the range 0..{}".format(nshards - 1))
+    return index, nshards
+
+
+def count_lines(fpath):
+    '''
+    Возвращает количество строк в файле.
+
+    :param fpath: путь к файлу
+    '''
+    lines = 0
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            lines += chunk.count(b"\n")
+    return lines
+
+
+class ShardMerge(object):
+    '''
+    Объединяет итоговые файлы частей в итоговые файлы каталога. Перед
+    объединением проверяется, что найдены все части, каждая из них
+    завершена, каждый архив каталога архивов обработан ровно одной частью,
+    к которой он относится, и не изменился после обработки, а количество
+    строк в итоговых файлах частей совпадает с записанным в их манифесты.
+    Итоговые файлы частей не изменяются.
+    '''
+
+    def __init__(self, arch_path, out_path):
+        '''
+        :param arch_path: путь к каталогу с архивами
+        :param out_path: каталог итоговых файлов, содержащий каталоги частей
+        '''
+        self.arch_path = arch_path
+        self.out_path = out_path
+
+    def find_shards(self):
+        '''
+        Возвращает пути к каталогам частей в порядке их номеров.
+        '''
+        found = {}
+        for fname in os.listdir(self.out_path):
+            match = SHARD_DIR_RE.match(fname)
+            if match is not None:
+                found[int(match.group(1)), int(match.group(2))] = \
+                    os.path.join(self.out_path, fname)
+        counts = set(nshards for index, nshards in found)
+        if not counts:
+            raise ShardError("No shards found in {}".format(self.out_path))
+        if len(counts) > 1:
+            raise ShardError("Shards of different splits found: {}".format(
+                ", ".join(str(n) for n in sorted(counts))))
+        nshards = counts.pop()
+        missing = [i for i in range(nshards) if (i, nshards) not in found]
+        if missing:
+            raise ShardError("Shards {} of {} are missing".format(
+                ", ".join(str(i) for i in missing), nshards))
+        return [found[i, nshards] for i in range(nshards)]
+
+    def verify(self, shard_dirs):
+        '''
+        Проверяет части и возвращает их манифесты и формат итоговых файлов.
+
+        :param shard_dirs: пути к каталогам частей в порядке их номеров
+        '''
+        nshards = len(shard_dirs)
+        manifests = []
+        owners = {}
+        formats = set()
+        for index, shard_dir in enumerate(shard_dirs):
+            manifest = Manifest(shard_dir)
+            manifest.load()
+            if not manifest.outputs:
+                raise ShardError("Shard {} has no manifest, it hasn't "
+                                 "finished".format(shard_dir))
+            for fname, size in manifest.outputs.items():
+                fpath = os.path.join(shard_dir, fname)
+                if (not os.path.exists(fpath) or
+                        os.path.getsize(fpath) != size):
+                    raise ShardError("Shard {} was interrupted, run it "
+                                     "again".format(shard_dir))
+            if set(manifest.outputs) == set(OUTPUT_FILES):
+                formats.add("columnar")
+            else:
+                formats.add("csv")
+            for arch_fname in manifest.archives:
+                if shard_of(arch_fname, nshards) != index:
+                    raise ShardError("Archive {a} doesn't belong to shard "
+                                     "{s}".format(a=arch_fname, s=shard_dir))
+                if arch_fname in owners:
+                    raise ShardError("Archive {a} is processed by shards "
+                                     "{s1} and {s2}".format(
+                                        a=arch_fname, s1=owners[arch_fname],
+                                        s2=shard_dir))
+                owners[arch_fname] = shard_dir
+            self.verify_rows(shard_dir, manifest)
+            manifests.append(manifest)
+        if len(formats) > 1:
+            raise ShardError("Shards have different output formats")
+
+        archives = set(fname for fname in os.listdir(self.arch_path)
+                       if fname.endswith(".zip") and
+                       os.path.isfile(os.path.join(self.arch_path, fname)))
+        missed = sorted(archives - set(owners))
+        if missed:
+            raise ShardError("Archives aren't processed by any shard: "
+                             "{}".format(", ".join(missed)))
+        removed = sorted(set(owners) - archives)
+        if removed:
+            raise ShardError("Processed archives no longer exist: "
+                             "{}".format(", ".join(removed)))
+        for arch_fname, shard_dir in sorted(owners.items()):
+            manifest = manifests[shard_dirs.index(shard_dir)]
+            arch_stat = Manifest.archive_stat(
+                            os.path.join(self.arch_path, arch_fname))
+            if not manifest.is_unchanged(arch_fname, arch_stat):
+                raise ShardError("Archive {a} has changed since shard {s} "
+                                 "processed it".format(a=arch_fname,
+                                                       s=shard_dir))
+        return manifests, formats.pop()
+
+    @staticmethod
+    def verify_rows(shard_dir, manifest):
+        '''
+        Проверяет, что количество строк в итоговых файлах части совпадает с
+        суммой строк архивов в её манифесте.
+
+        :param shard_dir: каталог части
+        :param manifest: манифест части
+        '''
+        for dataset in ("levels", "objects"):
+            expected = sum(record["{}_rows".format(dataset)]
+                           for record in manifest.archives.values())
+            if "{}.csv".format(dataset) in manifest.outputs:
+                rows = count_lines(os.path.join(shard_dir,
+                                                "{}.csv".format(dataset)))
+            else:
+                rows = (manifest.outputs[column_fname(dataset, "id")] //
+                        array("q").itemsize)
+            if rows != expected:
+                raise ShardError("Shard {s}: {d} has {r} rows, the manifest "
+                                 "records {e}".format(s=shard_dir, d=dataset,
+                                                      r=rows, e=expected))
+
+    def merge_csv(self, shard_dirs):
+        '''
+        Объединяет csv-файлы частей средствами ядра (см. gen.append_file).
+
+        :param shard_dirs: пути к каталогам частей в порядке их номеров
+        '''
+        # Модуль gen импортирует этот модуль, поэтому append_file
+        # импортируется при вызове.
+        from gen import append_file
+        for fname in ("levels.csv", "objects.csv"):
+            with open(os.path.join(self.out_path, fname), "wb",
+                      buffering=0) as out_file:
+                for shard_dir in shard_dirs:
+                    append_file(out_file, os.path.join(shard_dir, fname))
+
+    def merge_columns(self, shard_dirs):
+        '''
+        Объединяет файлы частей в формате columnar, перекодируя номера имён
+        объектов в общий словарь частями по MERGE_CHUNK_ROWS строк.
+
+        :param shard_dirs: пути к каталогам частей в порядке их номеров
+        '''
+        with ColumnarStore(self.out_path) as store:
+            for shard_dir in shard_dirs:
+                with open(os.path.join(shard_dir, DICT_FNAME), "r",
+                          encoding="utf-8") as f:
+                    names = [json.loads(line) for line in f]
+                for dataset in ("levels", "objects"):
+                    columns = [(column, typecode,
+                                open(os.path.join(shard_dir, column_fname(
+                                    dataset, column)), "rb"))
+                               for ds, column, typecode in COLUMNS
+                               if ds == dataset]
+                    try:
+                        while True:
+                            chunk = {"columns": dict(
+                                        ((ds, column), b"")
+                                        for ds, column, typecode in COLUMNS),
+                                     "names": names}
+                            for column, typecode, f in columns:
+                                chunk["columns"][dataset, column] = f.read(
+                                    MERGE_CHUNK_ROWS *
+                                    array(typecode).itemsize)
+                            if not any(chunk["columns"].values()):
+                                break
+                            store.append(chunk)
+                    finally:
+                        for column, typecode, f in columns:
+                            f.close()
+
+    def run(self):
+        '''
+        Проверяет и объединяет части. Записывает в каталог итоговых файлов
+        манифест со сведениями обо всех архивах, поэтому объединённые файлы
+        можно дополнять запуском в режиме incremental. При ошибке
+        проверки возникает ShardError. Возвращает формат итоговых файлов.
+        '''
+        shard_dirs = self.find_shards()
+        manifests, output_format = self.verify(shard_dirs)
+        manifest = Manifest(self.out_path)
+        for shard_manifest in manifests:
+            manifest.archives.update(shard_manifest.archives)
+        if output_format == "columnar":
+            self.merge_columns(shard_dirs)
+            manifest.update_outputs(OUTPUT_FILES)
+        else:
+            self.merge_csv(shard_dirs)
+            manifest.update_outputs(["levels.csv", "objects.csv"])
+        manifest.save()
+        print("{n} shards with {a} archives were merged into {p}.".format(
+                n=len(shard_dirs), a=len(manifest.archives), p=self.out_path))
+        return output_format
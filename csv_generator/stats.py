@@ -0,0 +1,230 @@
+'''
+Модуль содержит класс для сбора показателей работы стадий и процессов.
+'''
+
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+
+
+# Счётчики, которые задачи возвращают в словаре результата.
+COUNTERS = ("files", "bytes", "levels_rows", "objects_rows", "errors")
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    '''
+    Возвращает пиковый размер резидентной памяти в килобайтах.
+
+    :param who: resource.RUSAGE_SELF или resource.RUSAGE_CHILDREN
+    '''
+    return resource.getrusage(who).ru_maxrss
+
+
+def measure_call(func, args):
+    '''
+    Выполняет func(*args) и возвращает пару из результата и показателей
+    выполнения: номера процесса, времени выполнения, процессорного времени,
+    пикового размера памяти процесса и счётчиков COUNTERS, если func
+    вернула словарь с ними.
+
+    :param func: выполняемая функция
+    :param args: кортеж аргументов
+    '''
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func(*args)
+    metrics = {
+        "pid": os.getpid(),
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "max_rss_kb": peak_rss(),
+    }
+    if isinstance(result, dict):
+        for name in COUNTERS:
+            if name in result:
+                metrics[name] = result[name]
+    return result, metrics
+
+
+def empty_totals():
+    '''
+    Возвращает словарь суммарных показателей с нулевыми значениями.
+    '''
+    totals = dict((name, 0) for name in COUNTERS)
+    totals.update(tasks=0, wall=0.0, cpu=0.0, max_rss_kb=0)
+    return totals
+
+
+def add_metrics(totals, metrics):
+    '''
+    Добавляет показатели задачи к суммарным показателям.
+
+    :param totals: словарь суммарных показателей (см. empty_totals)
+    :param metrics: показатели задачи (см. measure_call)
+    '''
+    totals["tasks"] += 1
+    totals["wall"] += metrics.get("wall", 0.0)
+    totals["cpu"] += metrics.get("cpu", 0.0)
+    totals["max_rss_kb"] = max(totals["max_rss_kb"],
+                               metrics.get("max_rss_kb", 0))
+    for name in COUNTERS:
+        totals[name] += metrics.get(name, 0)
+
+
+class Stats(object):
+    '''
+    Собирает показатели стадий обработки: время выполнения стадии и для
+    каждой стадии и каждого процесса - суммарное время и процессорное время
+    задач, количество файлов, байт, строк csv-файлов и ошибок разбора, а
+    также пиковый размер памяти. Показатели добавляются из разных потоков,
+    поэтому доступ к ним защищён блокировкой.
+    '''
+
+    def __init__(self, progress_interval=None, progress_file=sys.stderr):
+        '''
+        :param progress_interval: период вывода строк о ходе выполнения в
+                                  секундах. По умолчанию строки не выводятся
+        :param progress_file: файловый объект для строк о ходе выполнения
+        '''
+        self.lock = threading.Lock()
+        self.start_ts = time.time()
+        self.start_wall = time.perf_counter()
+        self.stages = {}
+        self.workers = {}
+        self.current_stage = None
+        self.progress_interval = progress_interval
+        self.progress_file = progress_file
+        self.progress_stop = threading.Event()
+        self.progress_thread = None
+
+    def stage_totals(self, name):
+        '''
+        Возвращает суммарные показатели стадии, создавая их при
+        необходимости. Вызывается под блокировкой.
+
+        :param name: имя стадии
+        '''
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = empty_totals()
+            totals.update(stage_wall=0.0, total_tasks=0)
+            self.stages[name] = totals
+        return totals
+
+    @contextlib.contextmanager
+    def stage(self, name, ntasks=0):
+        '''
+        Контекст выполнения стадии: учитывает время её выполнения и
+        количество задач для вывода хода выполнения.
+
+        :param name: имя стадии
+        :param ntasks: количество задач стадии, если оно известно заранее
+        '''
+        with self.lock:
+            self.stage_totals(name)["total_tasks"] += ntasks
+            self.current_stage = name
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stage_totals(name)["stage_wall"] += \
+                    time.perf_counter() - st
+
+    def add(self, stage, metrics):
+        '''
+        Добавляет показатели выполненной задачи.
+
+        :param stage: имя стадии
+        :param metrics: показатели задачи (см. measure_call)
+        '''
+        with self.lock:
+            add_metrics(self.stage_totals(stage), metrics)
+            worker = self.workers.setdefault(metrics.get("pid", os.getpid()),
+                                             {})
+            if stage not in worker:
+                worker[stage] = empty_totals()
+            add_metrics(worker[stage], metrics)
+
+    def report(self):
+        '''
+        Возвращает отчёт в виде словаря, пригодного для сохранения в JSON.
+        '''
+        with self.lock:
+            stages = {}
+            for name, totals in self.stages.items():
+                totals = dict(totals)
+                totals["rows"] = totals["levels_rows"] + totals["objects_rows"]
+                stages[name] = totals
+            return {
+                "start": self.start_ts,
+                "wall": time.perf_counter() - self.start_wall,
+                "cpu": time.process_time(),
+                "max_rss_kb": peak_rss(),
+                "children_max_rss_kb": peak_rss(resource.RUSAGE_CHILDREN),
+                "stages": stages,
+                "workers": dict((str(pid), worker) for pid, worker
+                                in self.workers.items()),
+            }
+
+    def save(self, fpath):
+        '''
+        Сохраняет отчёт в формате JSON.
+
+        :param fpath: путь к файлу отчёта
+        '''
+        with open(fpath, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+    def progress_line(self):
+        '''
+        Возвращает строку о ходе выполнения текущей стадии.
+        '''
+        with self.lock:
+            name = self.current_stage
+            if name is None:
+                return "elapsed {:.1f}s".format(
+                        time.perf_counter() - self.start_wall)
+            totals = self.stages[name]
+            tasks = str(totals["tasks"])
+            if totals["total_tasks"]:
+                tasks += "/{}".format(totals["total_tasks"])
+            return ("elapsed {elapsed:.1f}s stage {name}: tasks {tasks}, "
+                    "files {files}, rows {rows}, errors {errors}"
+                    .format(elapsed=time.perf_counter() - self.start_wall,
+                            name=name, tasks=tasks, files=totals["files"],
+                            rows=totals["levels_rows"] +
+                            totals["objects_rows"],
+                            errors=totals["errors"]))
+
+    def progress_loop(self):
+        '''
+        Выводит строки о ходе выполнения до вызова stop_progress.
+        Выполняется в отдельном потоке.
+        '''
+        while not self.progress_stop.wait(self.progress_interval):
+            print(self.progress_line(), file=self.progress_file, flush=True)
+
+    def start_progress(self):
+        '''
+        Запускает поток, периодически выводящий строки о ходе выполнения.
+        '''
+        if not self.progress_interval:
+            return
+        self.progress_thread = threading.Thread(target=self.progress_loop)
+        self.progress_thread.daemon = True
+        self.progress_thread.start()
+
+    def stop_progress(self):
+        '''
+        Останавливает вывод строк о ходе выполнения.
+        '''
+        if self.progress_thread is not None:
+            self.progress_stop.set()
+            self.progress_thread.join()
+            self.progress_thread = None
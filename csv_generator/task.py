@@ -5,7 +5,14 @@
 import os
 import argparse
 from shutil import rmtree
-from gen import ArchGen, CsvGen
+from gen import ArchGen, CsvGen, COMPRESSIONS, build_indexes
+from pipeline import CsvPipeline
+from manifest import Manifest
+from shards import ShardMerge, ShardError, parse_shard
+from idindex import Lookup, IdIndexError
+from stats import Stats
+from xmlfile import RENDERERS
+from xmlhandler import ENGINES
 
 
 def main():
@@ -21,10 +28,13 @@ def main():
     parser = argparse.ArgumentParser(
                 description="Архиватор и csv генератор.")
     parser.add_argument("-c", "--command", default="zip", type=str,
-                        choices=["zip", "csv"],
+                        choices=["zip", "csv", "merge", "lookup"],
                         help="Выполняемое действие: zip - архивирование "
                              "сгенерированнх xml-файлов; csv - генерация "
-                             "csv-файлов из zip-архивов.")
+                             "csv-файлов из zip-архивов; merge - проверка и "
+                             "объединение итоговых файлов частей, созданных "
+                             "с параметром shard; lookup - поиск строк по "
+                             "значениям id с помощью индекса.")
     parser.add_argument("-p", "--path", type=str,
                         help="Путь к каталогу, в котором будут генерироваться "
                              "и архивироваться xml-файлы.")
@@ -33,20 +43,182 @@ def main():
     parser.add_argument("-x", "--xmlcount", type=int, default=100,
                         help="Количество xml-файлов в архиве. "
                              "По умолчанию: 100.")
+    parser.add_argument("--gen-mode", type=str, default="memory",
+                        choices=ArchGen.gen_modes,
+                        help="Способ помещения xml-файлов в архив: memory - "
+                             "сгенерированный текст записывается в архив "
+                             "напрямую; file - через временные файлы на "
+                             "диске; parallel - архивы создаются по одному, "
+                             "xml-файлы каждого архива генерируются и "
+                             "сжимаются в пуле процессов, а архив собирается "
+                             "одним процессом. "
+                             "По умолчанию: memory.")
+    parser.add_argument("--compression", type=str, default="stored",
+                        choices=sorted(COMPRESSIONS),
+                        help="Способ сжатия xml-файлов в архиве. "
+                             "По умолчанию: stored (без сжатия).")
+    parser.add_argument("--level", type=int,
+                        help="Степень сжатия: 0-9 для deflate, 1-9 для "
+                             "bzip2. По умолчанию используется степень, "
+                             "принятая для способа сжатия.")
+    parser.add_argument("--tmp-path", type=str,
+                        help="Каталог для временных файлов. По умолчанию "
+                             "совпадает с каталогом из параметра path.")
+    parser.add_argument("--buffer-size", type=int,
+                        default=ArchGen.default_buffer_size,
+                        help="Размер буфера записи архива (в байтах) в "
+                             "режиме memory. По умолчанию: "
+                             "{}.".format(ArchGen.default_buffer_size))
+    parser.add_argument("--renderer", type=str, default="jinja",
+                        choices=RENDERERS,
+                        help="Способ генерации xml-файлов: jinja - по "
+                             "шаблону xmlfile.templ с помощью Jinja2; "
+                             "string - сборка строки без Jinja2 с тем же "
+                             "результатом. По умолчанию: jinja.")
+    parser.add_argument("-s", "--seed", type=int,
+                        help="Начальное значение генератора случайных "
+                             "значений. Для каждого архива из него и номера "
+                             "архива получается своё начальное состояние, "
+                             "поэтому при одном и том же значении архивы "
+                             "повторяются побайтно при любом числе процессов. "
+                             "По умолчанию значения не повторяются.")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Количество процессов, обрабатывающих архивы "
+                             "одновременно. По умолчанию равно количеству "
+                             "процессоров.")
+    parser.add_argument("--csv-mode", type=str, default="stream",
+                        choices=CsvGen.csv_modes,
+                        help="Способ обработки архивов: stream - xml-файлы "
+                             "читаются прямо из архивов; extract - архивы "
+                             "сначала распаковываются на диск; pipeline - "
+                             "конвейер, записывающий строки сразу в итоговые "
+                             "csv-файлы. По умолчанию: stream.")
+    parser.add_argument("-o", "--out-path", type=str,
+                        help="Каталог для csv-файлов. По умолчанию "
+                             "совпадает с каталогом из параметра path.")
+    parser.add_argument("-e", "--engine", type=str, default="expat",
+                        choices=sorted(ENGINES),
+                        help="Движок парсинга xml-файлов: sax - xml.sax с "
+                             "обработчиком XmlHandler; expat - pyexpat "
+                             "напрямую; etree - xml.etree.ElementTree. "
+                             "По умолчанию: expat.")
+    parser.add_argument("--queue-size", type=int,
+                        default=CsvPipeline.default_queue_size,
+                        help="Максимальное количество пакетов xml-файлов в "
+                             "очередях конвейера (режим pipeline). "
+                             "По умолчанию: {}.".format(
+                                CsvPipeline.default_queue_size))
+    parser.add_argument("--batch-size", type=int,
+                        default=CsvPipeline.default_batch_size,
+                        help="Количество xml-файлов в пакете конвейера "
+                             "(режим pipeline). По умолчанию: {}.".format(
+                                CsvPipeline.default_batch_size))
+    parser.add_argument("--ordered", action="store_true",
+                        help="Упорядочить строки csv-файлов по номеру архива "
+                             "и xml-файла, чтобы повторные запуски давали "
+                             "одинаковые файлы.")
+    parser.add_argument("--output-format", type=str, default="csv",
+                        choices=CsvGen.output_formats,
+                        help="Формат итоговых файлов: csv - levels.csv и "
+                             "objects.csv; columnar - двоичный поколоночный "
+                             "формат с целочисленными колонками фиксированной "
+                             "ширины и словарём имён объектов, который "
+                             "отображается в память без разбора. "
+                             "По умолчанию: csv.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Обрабатывать только новые и изменённые архивы. "
+                             "Сведения об обработанных архивах сохраняются "
+                             "в файле {} в каталоге csv-файлов.".format(
+                                Manifest.fname))
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Обработать только архивы части i из N "
+                             "(0 <= i < N). Итоговые файлы и манифест части "
+                             "сохраняются в каталог shard_i_of_N каталога "
+                             "csv-файлов, после обработки всех частей их "
+                             "объединяет команда merge.")
+    parser.add_argument("--index", action="store_true",
+                        help="Построить после генерации (или объединения "
+                             "частей) индексы итоговых файлов по значению "
+                             "id для команды lookup.")
+    parser.add_argument("--id", type=int, nargs="+", dest="ids",
+                        metavar="ID",
+                        help="Значения id, строки которых выводит команда "
+                             "lookup.")
+    parser.add_argument("--stats", type=str, metavar="FILE",
+                        help="Сохранить при завершении показатели стадий и "
+                             "процессов (время, процессорное время, файлы, "
+                             "байты, строки, ошибки разбора, пиковая память) "
+                             "в заданный файл в формате JSON.")
+    parser.add_argument("--progress", type=float, metavar="SECONDS",
+                        help="Выводить в stderr строку о ходе выполнения "
+                             "с заданным периодом.")
     args = parser.parse_args()
 
+    # Без --stats и --progress показатели не собираются.
+    stats = None
+    if args.stats or args.progress:
+        stats = Stats(args.progress)
+        stats.start_progress()
+    try:
+        run_command(args, stats)
+    finally:
+        if stats is not None:
+            stats.stop_progress()
+            if args.stats:
+                stats.save(args.stats)
+
+
+def run_command(args, stats):
+    '''
+    Выполняет команду, заданную параметрами запуска.
+
+    :param args: разобранные параметры запуска
+    :param stats: объект Stats для сбора показателей или None
+    '''
     if args.command == "zip":
         if os.path.exists(args.path):
             rmtree(args.path)
         os.mkdir(args.path)
-        ArchGen(args.path, args.archcount, args.xmlcount).zip_all()
+        ArchGen(args.path, args.archcount, args.xmlcount, args.gen_mode,
+                args.tmp_path, args.buffer_size, args.jobs,
+                stats=stats, renderer=args.renderer,
+                seed=args.seed, compression=args.compression,
+                level=args.level).zip_all()
     elif args.command == "csv":
         if not os.path.exists(args.path):
             print("Directory {} doesn't exist. Run the script "
                   "with --command=zip".format(args.path))
             exit(1)
-        csv = CsvGen(args.path)
+        if args.out_path and not os.path.exists(args.out_path):
+            os.makedirs(args.out_path)
+        csv = CsvGen(args.path, args.jobs, args.csv_mode, args.out_path,
+                     args.engine, args.queue_size, args.batch_size,
+                     args.ordered, args.incremental, stats,
+                     args.output_format, args.shard, args.index)
         csv.gen_csv_files()
+    elif args.command == "merge":
+        out_path = args.out_path or args.path
+        try:
+            output_format = ShardMerge(args.path, out_path).run()
+        except ShardError as exc:
+            print("Shards couldn't be merged: {}".format(exc))
+            exit(1)
+        if args.index:
+            build_indexes(out_path, output_format, args.jobs, stats)
+    elif args.command == "lookup":
+        if not args.ids:
+            print("Specify values with --id")
+            exit(1)
+        try:
+            lookup = Lookup(args.out_path or args.path, args.output_format)
+        except IdIndexError as exc:
+            print(exc)
+            exit(1)
+        for value_id in args.ids:
+            rows = lookup.lookup(value_id)
+            for dataset in ("levels", "objects"):
+                for row in rows[dataset]:
+                    print("{}:{}".format(dataset, row))
 
 
 if __name__ == "__main__":
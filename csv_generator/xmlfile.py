@@ -3,8 +3,102 @@
 '''
 
 import os
+import random
 from random import randrange
-from jinja2 import Environment, FileSystemLoader
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Способы генерации xml-текста: jinja - по шаблону xmlfile.templ с помощью
+# Jinja2; string - сборка строки без Jinja2 с тем же результатом.
+RENDERERS = ["jinja", "string"]
+
+TEMPL_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPL_NAME = "xmlfile.templ"
+
+# Скомпилированный шаблон, общий для всех xml-файлов процесса.
+_template = None
+
+
+def get_template():
+    '''
+    Возвращает скомпилированный шаблон xmlfile.templ. Шаблон загружается
+    один раз на процесс, Jinja2 импортируется только при первом вызове.
+    '''
+    global _template
+    if _template is None:
+        from jinja2 import Environment, FileSystemLoader
+        env = Environment(loader=FileSystemLoader(TEMPL_DIR))
+        _template = env.get_template(TEMPL_NAME)
+    return _template
+
+
+def gen_batch(count, seed=None, nobjects=None):
+    '''
+    Генерирует случайные значения сразу для count xml-файлов. Если
+    установлен NumPy, значения генерируются векторно, иначе - модулем
+    random. Для одного и того же seed результат повторяется, но отличается
+    в зависимости от того, установлен ли NumPy. Возвращает список пар из
+    значения level и списка имён объектов.
+
+    :param count: количество xml-файлов
+    :param seed: список целых чисел, из которых получается начальное
+                 состояние генератора. Если не задан, используется
+                 случайное начальное состояние от операционной системы
+    :param nobjects: количество элементов object в каждом xml-файле. По
+                     умолчанию выбирается случайно от 1 до 10
+    '''
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        levels = rng.integers(1, 101, count)
+        if nobjects is None:
+            counts = rng.integers(1, 11, count)
+        else:
+            counts = numpy.full(count, nobjects)
+        values = rng.integers(1, 1001, int(counts.sum()))
+        names = ["value-" + str(v) for v in values.tolist()]
+        ends = numpy.cumsum(counts).tolist()
+        levels = levels.tolist()
+    else:
+        rnd = random.Random(None if seed is None
+                            else ":".join(str(s) for s in seed))
+        levels = [rnd.randrange(1, 101) for i in range(count)]
+        if nobjects is None:
+            counts = [rnd.randrange(1, 11) for i in range(count)]
+        else:
+            counts = [nobjects] * count
+        ends = []
+        total = 0
+        for c in counts:
+            total += c
+            ends.append(total)
+        names = ["value-" + str(rnd.randrange(1, 1001))
+                 for i in range(total)]
+    starts = [0] + ends[:-1]
+    return [(level, names[start:end])
+            for level, start, end in zip(levels, starts, ends)]
+
+
+def render_string(data):
+    '''
+    Формирует xml-текст той же структуры, что и шаблон xmlfile.templ, без
+    использования Jinja2. Результат совпадает с результатом шаблона
+    побайтно.
+
+    :param data: словарь значений value_id, rand и rand_strings
+    '''
+    return ("<root>\n"
+            "<var name='id' value='{value_id}'/>\n"
+            "<var name='level' value='{rand}'/>\n"
+            "<objects>{objects}\n"
+            "</objects>\n"
+            "</root>\n").format(
+                value_id=data["value_id"], rand=data["rand"],
+                objects="".join("\n<object name='{}'/>".format(rs)
+                                for rs in data["rand_strings"]))
 
 
 class XmlFile(object):
@@ -15,20 +109,31 @@ class XmlFile(object):
     этими данными вышеуказанного шаблона.
     '''
 
-    def __init__(self, xml_id):
+    def __init__(self, xml_id, nobjects=None, renderer="jinja", values=None):
         '''
         :param xml_id: номер генериуемого xml-файла, значение соответствующего
                        атрибута id в xml-файле.
+        :param nobjects: количество элементов object. По умолчанию выбирается
+                         случайно от 1 до 10.
+        :param renderer: способ генерации xml-текста из RENDERERS.
+        :param values: заранее сгенерированные значения (см. gen_batch):
+                       пара из значения level и списка имён объектов. По
+                       умолчанию значения генерируются в конструкторе.
         '''
         self.data = {}
         self.data["value_id"] = xml_id
-        self.data["rand"] = randrange(1, 101)
-        self.data["rand_strings"] = ["value-" + str(randrange(1, 1001))
-                                     for i in range(randrange(1, 11))]
-        self.cwd = os.path.dirname(os.path.abspath(__file__))
-        env = Environment(loader=FileSystemLoader(self.cwd))
-        template = env.get_template("xmlfile.templ")
-        self.content = template.render(self.data)
+        if values is not None:
+            self.data["rand"], self.data["rand_strings"] = values
+        else:
+            self.data["rand"] = randrange(1, 101)
+            if nobjects is None:
+                nobjects = randrange(1, 11)
+            self.data["rand_strings"] = ["value-" + str(randrange(1, 1001))
+                                         for i in range(nobjects)]
+        if renderer == "string":
+            self.content = render_string(self.data)
+        else:
+            self.content = get_template().render(self.data)
 
     def xml_content(self):
         '''
@@ -1,19 +1,44 @@
 '''
-Модуль содержит класс для обработки xml-файла.
+Модуль содержит классы для обработки xml-файла.
+
+Обработка выполняется одним из парсеров (движков), перечисленных в ENGINES.
+Все движки сохраняют одинаковые данные и одинаково реагируют на отсутствие
+обязательных атрибутов.
 '''
 
 
 import xml.sax
+from xml.parsers import expat
+from xml.etree import ElementTree
+
+
+# Имена переменных, значения которых сохраняются в csv-файлы.
+VAR_NAMES = frozenset(["id", "level"])
+
+# Обязательные атрибуты элемента var.
+REQ_ATTRS = ("name", "value")
 
 
 class RequiredAttrError(Exception):
     pass
 
 
-class XmlHandler(xml.sax.ContentHandler):
+def check_var_attrs(attrs):
     '''
-    Выполняет парсинг xml-файла для сохранения в указанный
-    файл необходимых значений в csv-формате.
+    Проверяет наличие обязательных атрибутов у элемента var.
+
+    :param attrs: атрибуты элемента, поддерживающие проверку вхождения.
+    '''
+    for attr in REQ_ATTRS:
+        if attr not in attrs:
+            msg = "the '{}' attribute absent.".format(attr)
+            raise RequiredAttrError(msg)
+
+
+class CsvWriter(object):
+    '''
+    Сохраняет значения, извлечённые из xml-файла, в csv-формате и
+    подсчитывает количество записанных строк.
     '''
 
     def __init__(self, levels_file, objects_file):
@@ -21,10 +46,41 @@ class XmlHandler(xml.sax.ContentHandler):
         :param levels_file: файловый объект для сохранения значений levels
         :param objects_file: файловый объект для сохранения значений objects
         '''
-        xml.sax.ContentHandler.__init__(self)
         self.levels_file = levels_file
         self.objects_file = objects_file
-        self.var_names = ["id", "level"]
+        self.levels_rows = 0
+        self.objects_rows = 0
+
+    def write(self, var_values, object_names):
+        '''
+        Сохраняет значения одного xml-файла.
+
+        :param var_values: словарь значений переменных id и level
+        :param object_names: список имён объектов
+        '''
+        value_id = var_values["id"]
+        self.levels_file.write('"{i}",{level}\n'.format(
+                                    i=value_id, level=var_values["level"]))
+        for name in object_names:
+            self.objects_file.write(
+                '"{i}","{name}"\n'.format(i=value_id, name=name))
+        self.levels_rows += 1
+        self.objects_rows += len(object_names)
+
+
+class XmlHandler(xml.sax.ContentHandler):
+    '''
+    Выполняет парсинг xml-файла для сохранения в указанный
+    файл необходимых значений в csv-формате.
+    '''
+
+    def __init__(self, writer):
+        '''
+        :param writer: объект для сохранения извлечённых значений
+                       (например, CsvWriter)
+        '''
+        xml.sax.ContentHandler.__init__(self)
+        self.writer = writer
         self.var_values = {}
         self.object_names = []
 
@@ -33,27 +89,124 @@ class XmlHandler(xml.sax.ContentHandler):
         self.object_names = []
 
     def endDocument(self):
-        self.levels_file.write('"{i}",{level}\n'.format(
-                                    i=self.var_values["id"],
-                                    level=self.var_values["level"]))
-        for name in self.object_names:
-            self.objects_file.write(
-                '"{i}","{name}"\n'.format(i=self.var_values["id"],
-                                          name=name))
+        self.writer.write(self.var_values, self.object_names)
 
     def startElement(self, name, attrs):
         if name == "var":
-            values = {}
-            for (k, v) in attrs.items():
-                values[k] = v
-            req_attrs = ["name", "value"]
-            for attr in req_attrs:
-                if attr not in values:
-                    msg = "the '{}' attribute absent.".format(attr)
-                    raise RequiredAttrError(msg)
-            if values["name"] in self.var_names:
-                self.var_values[values["name"]] = values["value"]
+            check_var_attrs(attrs)
+            var_name = attrs["name"]
+            if var_name in VAR_NAMES:
+                self.var_values[var_name] = attrs["value"]
+        elif name == "object":
+            object_name = attrs.get("name")
+            if object_name is not None:
+                self.object_names.append(object_name)
+
+
+class SaxEngine(object):
+    '''
+    Парсинг с помощью xml.sax и обработчика XmlHandler. Парсер
+    переиспользуется для всех xml-файлов.
+    '''
+
+    def __init__(self, writer):
+        '''
+        :param writer: объект для сохранения извлечённых значений
+        '''
+        self.parser = xml.sax.make_parser()
+        self.parser.setContentHandler(XmlHandler(writer))
+
+    def parse(self, source):
+        '''
+        :param source: файловый объект с текстом xml-файла
+        '''
+        self.parser.parse(source)
+
+
+class ExpatEngine(object):
+    '''
+    Парсинг напрямую с помощью pyexpat, без промежуточного слоя xml.sax.
+    Атрибуты элемента передаются в обработчик готовым словарём.
+    '''
+
+    def __init__(self, writer):
+        '''
+        :param writer: объект для сохранения извлечённых значений
+        '''
+        self.writer = writer
+        self.var_values = {}
+        self.object_names = []
+
+    def start_element(self, name, attrs):
+        if name == "var":
+            check_var_attrs(attrs)
+            var_name = attrs["name"]
+            if var_name in VAR_NAMES:
+                self.var_values[var_name] = attrs["value"]
         elif name == "object":
-            for (k, v) in attrs.items():
-                if k == "name":
-                    self.object_names.append(v)
+            object_name = attrs.get("name")
+            if object_name is not None:
+                self.object_names.append(object_name)
+
+    def parse(self, source):
+        '''
+        :param source: файловый объект с текстом xml-файла
+        '''
+        self.var_values = {}
+        self.object_names = []
+        # Парсер expat нельзя использовать повторно после окончания
+        # документа, поэтому он создаётся для каждого xml-файла.
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.start_element
+        parser.ParseFile(source)
+        self.writer.write(self.var_values, self.object_names)
+
+
+class EtreeEngine(object):
+    '''
+    Парсинг с помощью xml.etree.ElementTree: документ целиком строится
+    в памяти, а затем обходятся его элементы.
+    '''
+
+    def __init__(self, writer):
+        '''
+        :param writer: объект для сохранения извлечённых значений
+        '''
+        self.writer = writer
+
+    def parse(self, source):
+        '''
+        :param source: файловый объект с текстом xml-файла
+        '''
+        var_values = {}
+        object_names = []
+        for elem in ElementTree.parse(source).getroot().iter():
+            if elem.tag == "var":
+                attrs = elem.attrib
+                check_var_attrs(attrs)
+                var_name = attrs["name"]
+                if var_name in VAR_NAMES:
+                    var_values[var_name] = attrs["value"]
+            elif elem.tag == "object":
+                object_name = elem.get("name")
+                if object_name is not None:
+                    object_names.append(object_name)
+        self.writer.write(var_values, object_names)
+
+
+# Доступные движки парсинга.
+ENGINES = {
+    "sax": SaxEngine,
+    "expat": ExpatEngine,
+    "etree": EtreeEngine,
+}
+
+
+def make_engine(name, writer):
+    '''
+    Создаёт движок парсинга xml-файлов.
+
+    :param name: имя движка из ENGINES
+    :param writer: объект для сохранения извлечённых значений
+    '''
+    return ENGINES[name](writer)
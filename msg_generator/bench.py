@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Сравнение производительности способов передачи сообщений list и streams.
+# Для каждого способа и количества приложений запускаются экземпляры msg.py
+# с нулевым интервалом, то есть без задержек генерации и обработки, и
+# измеряется время от запуска до окончания приёма всех сообщений. Время
+# доставки сообщений берётся из метрик, которые приложения сохраняют в
+# хешах metrics:<имя приложения>. Способ list запускается в режиме
+# reliable, в котором, как и в streams, сообщения подтверждаются.
+#
+# Пример запуска:
+# ./bench.py -n 100000 -a 1,4 -b 100 -o run.json
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import redis
+from msg import BACKENDS
+
+
+MSG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "msg.py")
+
+
+# Запуск msg.py с общими параметрами подключения к redis.
+def run_msg(args, host, port, **kwargs):
+    return subprocess.Popen([sys.executable, MSG_PATH, "-t", host,
+                             "-p", str(port)] + args, **kwargs)
+
+
+# Замер для одного способа передачи и количества приложений. Возвращает
+# время приёма всех сообщений, достигнутую частоту, количество принятых
+# сообщений (с учётом повторно обработанных) и наибольшие по приложениям
+# оценки квантилей времени доставки.
+def measure(backend, apps, nmsg, batch, read_count, host, port):
+    run_msg(["-c", "clean"], host, port).wait()
+    args = ["-q", "-i", "0", "-n", str(nmsg), "-b", str(batch),
+            "-l", "1000", "--metrics-period", "1000",
+            "--backend", backend]
+    if backend == "streams":
+        args += ["--read-count", str(read_count),
+                 "--stream-maxlen", str(nmsg)]
+    else:
+        args += ["-r"]
+    st = time.time()
+    with open(os.devnull, "w") as devnull:
+        procs = [run_msg(args, host, port, stdout=devnull)
+                 for i in range(apps)]
+        for proc in procs:
+            proc.wait()
+    seconds = time.time() - st
+
+    rdb = redis.Redis(host=host, port=port)
+    metrics = [dict((k.decode("utf-8"), float(v))
+                    for k, v in rdb.hgetall(key).items()
+                    if k != b"name")
+               for key in rdb.scan_iter("metrics:*")]
+    return {
+        "seconds": seconds,
+        "msgs_per_sec": nmsg / seconds,
+        "accepted": int(sum(m["accepted"] for m in metrics)),
+        "end_to_end_p50": max(m["end_to_end_p50"] for m in metrics),
+        "end_to_end_p99": max(m["end_to_end_p99"] for m in metrics),
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+                description="Сравнение способов передачи сообщений.")
+    parser.add_argument("-n", "--number", default=100000, type=int,
+                        help="Количество сообщений в каждом замере. "
+                             "Значение по умолчанию: 100000.")
+    parser.add_argument("-a", "--apps", default=[1, 4], type=int_list,
+                        help="Список количеств приложений через запятую. "
+                             "Значение по умолчанию: 1,4.")
+    parser.add_argument("-b", "--batch", default=100, type=int,
+                        help="Количество сообщений, добавляемых "
+                             "генератором за одно обращение к redis. "
+                             "Значение по умолчанию: 100.")
+    parser.add_argument("--read-count", default=100, type=int,
+                        help="Количество сообщений, читаемых из потока за "
+                             "одно обращение к redis. Значение по "
+                             "умолчанию: 100.")
+    parser.add_argument("--backends", default=BACKENDS,
+                        type=lambda value: value.split(","),
+                        help="Список способов передачи через запятую. "
+                             "Значение по умолчанию: list,streams.")
+    parser.add_argument("-o", "--output", type=str,
+                        help="Файл для сохранения результатов в формате "
+                             "JSON. По умолчанию результаты выводятся "
+                             "на экран.")
+    parser.add_argument("-t", "--host", default="localhost", type=str,
+                        help="Имя хоста с redis. "
+                             "Значение по умолчанию: localhost")
+    parser.add_argument("-p", "--port", default=6379, type=str,
+                        help="Порт, на котором redis принимает соединения. "
+                             "Значение по умолчанию: 6379")
+    args = parser.parse_args()
+
+    runs = []
+    for apps in args.apps:
+        for backend in args.backends:
+            result = measure(backend, apps, args.number, args.batch,
+                             args.read_count, args.host, args.port)
+            runs.append(dict(result, backend=backend, apps=apps))
+            print("backend={} apps={}: {:.3f}s, {:.1f} msg/s, "
+                  "end-to-end p50 {} s, p99 {} s".format(
+                    backend, apps, result["seconds"],
+                    result["msgs_per_sec"], result["end_to_end_p50"],
+                    result["end_to_end_p99"]),
+                  file=sys.stderr)
+    report = json.dumps({"messages": args.number, "runs": runs}, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,25 +3,479 @@
 
 
 import argparse
+import asyncio
+import bisect
+import json
+import sys
 import redis
 import threading
 import time
 import signal
 from random import randrange
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                BrokenExecutor)
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    # Клиент redis.asyncio есть в redis-py, начиная с версии 4.2.
+    aioredis = None
+
+# Сигналы завершения, которые подавляются.
+# Процесс можно завершить по kill -9.
+COMPLETION_SIGNALS = [signal.SIGINT, signal.SIGQUIT, signal.SIGTERM,
+                      signal.SIGTSTP]
+
 
 # Обработчик сигнала завершения. Применяется для нескольких сигналов.
 def completion_handler(signum, frame):
     pass
 
 
-# Генерация сообщения по определённом формату <number>:<message>.
+# Генерация сообщения по определённом формату <number>:<ts>:<message>.
 # Поле <number> избыточное. Можно обойтись без него, но с помощью него
 # можно понять, что генерируются и обрабатываются все необходимые сообщения.
+# Поле <ts> - время генерации сообщения, по которому считается время
+# ожидания в очереди и время доставки сообщения.
 # Если сообщение оканчивается на число из диапазона [1, 5], то оно считается
 # ошибочным.
 def generate_message(number):
-    return "{number}:message-{rand}".format(number=number,
-                                            rand=randrange(1, 101))
+    return "{number}:{ts}:message-{rand}".format(number=number,
+                                                 ts=time.time(),
+                                                 rand=randrange(1, 101))
+
+
+# Разбор сообщения. Возвращает номер, время генерации и текст сообщения.
+def parse_message(msg):
+    (index, gen_ts, text) = msg.decode("utf-8").split(":")
+    return index, float(gen_ts), text
+
+
+# Границы интервалов гистограмм времени (с).
+HISTOGRAM_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                     0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Гистограмма значений с фиксированными границами интервалов. Значение
+# учитывается в первом интервале, верхняя граница которого не меньше его.
+class Histogram(object):
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Оценка квантили q сверху: граница интервала, в котором она находится.
+    def quantile(self, q):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total and total >= q * self.count:
+                return bound
+        return float("inf") if self.count else 0.0
+
+
+# Метрики приложения: счётчики сгенерированных и принятых сообщений,
+# сообщений с ошибками и замен генератора, а также гистограммы времени
+# ожидания сообщения в очереди, времени обработки и времени доставки от
+# генерации до окончания обработки. Время генерации записывает генератор,
+# поэтому время ожидания и доставки точно при синхронизированных часах.
+# Метрики обновляются из нескольких потоков под блокировкой.
+class Metrics(object):
+    counters = ("generated", "accepted", "errors", "takeovers")
+    histograms = ("queue_wait", "process", "end_to_end")
+
+    def __init__(self, name):
+
+        # Имя приложения.
+        self.name = name
+
+        # Блокировка метрик.
+        self.lock = threading.Lock()
+
+        # Значения счётчиков.
+        self.values = dict.fromkeys(self.counters, 0)
+
+        # Гистограммы времени.
+        self.hists = dict((name, Histogram()) for name in self.histograms)
+
+    def inc(self, counter, value=1):
+        with self.lock:
+            self.values[counter] += value
+
+    # Учёт обработанного сообщения.
+    def observe(self, gen_ts, accept_ts, duration, error):
+        done_ts = time.time()
+        with self.lock:
+            self.values["accepted"] += 1
+            if error:
+                self.values["errors"] += 1
+            self.hists["queue_wait"].observe(accept_ts - gen_ts)
+            self.hists["process"].observe(duration)
+            self.hists["end_to_end"].observe(done_ts - gen_ts)
+
+    # Метрики в текстовом формате Prometheus.
+    def render(self):
+        label = 'app="{}"'.format(self.name)
+        lines = []
+        with self.lock:
+            for counter in self.counters:
+                metric = "msg_{}_total".format(counter)
+                lines.append("# TYPE {} counter".format(metric))
+                lines.append("{m}{{{l}}} {v}".format(
+                                m=metric, l=label, v=self.values[counter]))
+            for name in self.histograms:
+                hist = self.hists[name]
+                metric = "msg_{}_seconds".format(name)
+                lines.append("# TYPE {} histogram".format(metric))
+                total = 0
+                for bound, count in zip(hist.buckets + ("+Inf",),
+                                        hist.counts):
+                    total += count
+                    lines.append('{m}_bucket{{{l},le="{b}"}} {v}'.format(
+                                    m=metric, l=label, b=bound, v=total))
+                lines.append("{m}_sum{{{l}}} {v}".format(
+                                m=metric, l=label, v=hist.sum))
+                lines.append("{m}_count{{{l}}} {v}".format(
+                                m=metric, l=label, v=hist.count))
+        return "\n".join(lines) + "\n"
+
+    # Метрики для сохранения в хеше redis: значения счётчиков, количество,
+    # сумма и оценки квантилей 0.5 и 0.99 значений гистограмм.
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+            for name in self.histograms:
+                hist = self.hists[name]
+                values[name + "_count"] = hist.count
+                values[name + "_sum"] = hist.sum
+                values[name + "_p50"] = hist.quantile(0.5)
+                values[name + "_p99"] = hist.quantile(0.99)
+        values["ts"] = time.time()
+        return values
+
+
+# Обработчик запросов HTTP-сервера метрик: GET /metrics возвращает метрики
+# в текстовом формате Prometheus.
+class MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Адрес, на котором HTTP-сервер метрик принимает соединения: метрики
+# доступны только с того же узла.
+METRICS_HOST = "127.0.0.1"
+
+
+# Запуск HTTP-сервера метрик в отдельном потоке.
+def start_metrics_server(metrics, port):
+    handler = type("AppMetricsHandler", (MetricsHandler,),
+                   {"metrics": metrics})
+    server = ThreadingHTTPServer((METRICS_HOST, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# Имя хеша, в котором приложение периодически сохраняет метрики.
+def metrics_key(name):
+    return "metrics:{}".format(name)
+
+
+# Скрипт пакетной генерации сообщений. Проверка того, что приложение всё ещё
+# является генератором, и добавление пакета сообщений в очередь выполняются
+# атомарно за одно обращение к redis.
+# KEYS: generator, last_index, queue.
+# ARGV: имя приложения, номер последнего сообщения пакета, сообщения пакета.
+# Возвращает 1, если сообщения добавлены, и 0, если генератор сменился.
+# Сообщения добавляются частями по PUSH_CHUNK_SIZE, так как количество
+# аргументов unpack ограничено размером стека Lua.
+PUSH_CHUNK_SIZE = 1000
+
+PUSH_BATCH_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2])
+for i = 3, #ARGV, %d do
+    redis.call('RPUSH', KEYS[3], unpack(ARGV, i, math.min(i + %d, #ARGV)))
+end
+return 1
+""" % (PUSH_CHUNK_SIZE, PUSH_CHUNK_SIZE - 1)
+
+
+# Способы передачи сообщений: list - список queue; streams - поток
+# STREAM_KEY с группой потребителей STREAM_GROUP, сообщения с ошибками
+# сохраняются в поток ERRORS_STREAM_KEY.
+BACKENDS = ["list", "streams"]
+
+STREAM_KEY = "queue_stream"
+
+ERRORS_STREAM_KEY = "errors_stream"
+
+STREAM_GROUP = "handlers"
+
+
+# Скрипт пакетной генерации сообщений в поток (см. PUSH_BATCH_SCRIPT). Длина
+# потока ограничивается приблизительно (MAXLEN ~): если потребители
+# отстанут больше, чем на это количество сообщений, старые сообщения будут
+# удалены.
+# KEYS: generator, last_index, поток сообщений.
+# ARGV: имя приложения, номер последнего сообщения пакета, максимальная
+# длина потока, сообщения пакета.
+PUSH_STREAM_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2])
+for i = 4, #ARGV do
+    redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[3], '*', 'msg', ARGV[i])
+end
+return 1
+"""
+
+
+# Скрипт извлечения части сообщений с ошибками из потока: сообщения
+# читаются и удаляются атомарно.
+# KEYS: поток сообщений с ошибками.
+# ARGV: количество сообщений.
+DRAIN_STREAM_SCRIPT = """
+local entries = redis.call('XRANGE', KEYS[1], '-', '+', 'COUNT', ARGV[1])
+for i, entry in ipairs(entries) do
+    redis.call('XDEL', KEYS[1], entry[1])
+end
+return entries
+"""
+
+
+# Скрипт захвата аренды роли генератора. Ключ generator создаётся с временем
+# жизни, только если его нет, то есть предыдущая аренда истекла. В хеше
+# generator_lease хранятся имя арендатора и время последнего продления
+# аренды.
+# KEYS: generator, generator_lease.
+# ARGV: имя приложения, время жизни аренды (мс), текущее время.
+# Возвращает nil, если аренда занята, или имя предыдущего арендатора и время
+# последнего продления им аренды.
+LEASE_ACQUIRE_SCRIPT = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return nil
+end
+local prev = redis.call('HMGET', KEYS[2], 'name', 'ts')
+redis.call('HSET', KEYS[2], 'name', ARGV[1], 'ts', ARGV[3])
+return prev
+"""
+
+
+# Скрипт продления аренды роли генератора текущим арендатором.
+# KEYS: generator, generator_lease.
+# ARGV: имя приложения, время жизни аренды (мс), текущее время.
+# Возвращает 1, если аренда продлена, и 0, если она потеряна.
+LEASE_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[2], 'ts', ARGV[3])
+return 1
+"""
+
+
+# Способы восполнения пропущенных сообщений, если генератор отстал от
+# расписания: burst - все пропущенные сообщения генерируются сразу; skip -
+# сообщения, отставшие больше, чем на SKIP_TICKS периодов пробуждения, не
+# восполняются, расписание сдвигается; smooth - пропущенные сообщения
+# восполняются с частотой, в SMOOTH_RATE раз больше заданной.
+CATCH_UP_MODES = ["burst", "skip", "smooth"]
+
+SKIP_TICKS = 2
+
+SMOOTH_RATE = 2
+
+# Период сохранения достигнутой частоты генерации (с).
+RATE_REPORT_PERIOD = 1.0
+
+
+# Планировщик пакетной генерации сообщений. Сообщение с номером i должно
+# быть сгенерировано в момент start + (i - 1) * interval. Генератор
+# просыпается не чаще, чем раз в tick, и за одно пробуждение генерирует все
+# сообщения, время которых наступило, поэтому интервал может быть меньше
+# точности time.sleep. Планировщик также считает достигнутую частоту
+# генерации.
+class RateScheduler(object):
+    def __init__(self, interval, start_ts, number, catch_up="burst",
+                 tick=0.001):
+
+        # Интервал между сообщениями.
+        self.interval = interval
+
+        # Время генерации первого сообщения. В режиме skip сдвигается на
+        # время пропущенных сообщений.
+        self.start_ts = start_ts
+
+        # Номер следующего сообщения.
+        self.number = number
+
+        # Способ восполнения пропущенных сообщений из CATCH_UP_MODES.
+        self.catch_up = catch_up
+
+        # Минимальный период между пробуждениями генератора.
+        self.tick = max(tick, interval)
+
+        # Количество сообщений за один период.
+        self.per_tick = (max(1, int(round(self.tick / interval)))
+                         if interval > 0 else 0)
+
+        # Время последнего пробуждения генератора.
+        self.tick_ts = time.time()
+
+        # Время начала генерации, количество сгенерированных и пропущенных
+        # сообщений и максимальное отставание от расписания.
+        self.begin_ts = self.tick_ts
+        self.generated = 0
+        self.skipped = 0
+        self.max_lag = 0.0
+
+    # Время, когда должно быть сгенерировано сообщение с номером number.
+    def slot_ts(self, number):
+        return self.start_ts + self.interval * (number - 1)
+
+    # Количество сообщений, которые нужно сгенерировать при пробуждении в
+    # момент cur_ts, но не более limit.
+    def take(self, cur_ts, limit):
+        self.tick_ts = cur_ts
+        if self.interval <= 0:
+            return limit
+        due = int((cur_ts - self.start_ts) / self.interval) + 1
+        count = due - self.number + 1
+        if count <= 0:
+            return 0
+        self.max_lag = max(self.max_lag, cur_ts - self.slot_ts(self.number))
+        if self.catch_up == "skip" and count > SKIP_TICKS * self.per_tick:
+            self.skipped += count - self.per_tick
+            self.start_ts += (count - self.per_tick) * self.interval
+            count = self.per_tick
+        elif self.catch_up == "smooth":
+            count = min(count, SMOOTH_RATE * self.per_tick)
+        return min(count, limit)
+
+    # Учёт сгенерированных сообщений.
+    def done(self, count):
+        self.number += count
+        self.generated += count
+
+    # Время ожидания до следующего пробуждения: до времени следующего
+    # сообщения, но не меньше периода tick.
+    def delay(self, cur_ts):
+        wake_ts = max(self.slot_ts(self.number), self.tick_ts + self.tick)
+        return wake_ts - cur_ts
+
+    # Заданная и достигнутая частота генерации (сообщений в секунду),
+    # количество сгенерированных и пропущенных сообщений и максимальное
+    # отставание от расписания (с).
+    def stats(self, cur_ts):
+        return {
+            "target": 1 / self.interval if self.interval > 0 else 0,
+            "achieved": self.generated / max(cur_ts - self.begin_ts, 1e-9),
+            "generated": self.generated,
+            "skipped": self.skipped,
+            "max_lag": self.max_lag,
+        }
+
+
+# Обработка текста сообщения в пуле обработчиков. Сообщения с ошибками не
+# сохраняются, а только отмечаются: их сохраняет MsgWorkers вместе с
+# подтверждением обработки. Возвращает признак ошибки и длительность
+# обработки.
+def process_text(text, interval):
+    st = time.time()
+    parts = text.split("-")
+    if int(parts[1]) <= 5:
+        return True, time.time() - st
+    time.sleep(interval)
+    return False, time.time() - st
+
+
+# Имя списка сообщений, которые обрабатывает приложение в режиме
+# параллельного приёма.
+def processing_key(name):
+    return "processing:{}".format(name)
+
+
+# Имя ключа, время жизни которого продлевает работающее приложение в режиме
+# параллельного приёма.
+def consumer_key(name):
+    return "consumer:{}".format(name)
+
+
+# Форматы вывода сообщений с ошибками: text - пронумерованные строки; json -
+# JSON-объекты с номером и текстом сообщения, по одному в строке.
+ERRORS_FORMATS = ["text", "json"]
+
+
+# Вывод сообщений с ошибками из списка errors частями по batch сообщений:
+# каждая часть извлекается за одно обращение к redis и сразу выводится,
+# поэтому в памяти хранится не больше одной части. Часть извлекается и
+# удаляется из списка атомарно транзакцией LRANGE + LTRIM, а в режиме peek
+# только читается. Если limit не 0, выводится не более limit сообщений.
+# Для способа передачи streams сообщения читаются из потока
+# ERRORS_STREAM_KEY и удаляются скриптом DRAIN_STREAM_SCRIPT.
+# Возвращает количество выведенных сообщений.
+def drain_errors(rdb, out, batch=10000, limit=0, peek=False, fmt="text",
+                 backend="list"):
+    number = 0
+    drain_stream = rdb.register_script(DRAIN_STREAM_SCRIPT)
+    last_id = "-"
+    while not limit or number < limit:
+        count = min(batch, limit - number) if limit else batch
+        if backend == "streams" and peek:
+            entries = rdb.xrange(ERRORS_STREAM_KEY, last_id, "+", count)
+            if entries:
+                last_id = "(" + entries[-1][0].decode("utf-8")
+            messages = [fields[b"msg"] for entry_id, fields in entries]
+        elif backend == "streams":
+            entries = drain_stream(keys=[ERRORS_STREAM_KEY], args=[count])
+            messages = [fields[1] for entry_id, fields in entries]
+        elif peek:
+            messages = rdb.lrange("errors", number, number + count - 1)
+        else:
+            pipe = rdb.pipeline()
+            pipe.lrange("errors", 0, count - 1)
+            pipe.ltrim("errors", count, -1)
+            messages = pipe.execute()[0]
+        if not messages:
+            break
+        lines = []
+        for message in messages:
+            number += 1
+            message = message.decode("utf-8")
+            if fmt == "json":
+                lines.append(json.dumps({"number": number,
+                                         "message": message}))
+            else:
+                lines.append("{number}. Message with error: {msg}".format(
+                                number=number, msg=message))
+        out.write("\n".join(lines) + "\n")
+        out.flush()
+    return number
 
 
 # Генерация именя экземпляра приложения по формату: <host>-<pid>.
@@ -47,32 +501,132 @@ class MsgGenerator(threading.Thread):
         # Блокировка, используемая при генерации сообщений.
         self.gen_lock = self.app.rdb.lock("gen_lock", 1)
 
-        # Номер сообщения, которое будет сгенерировано.
-        self.cur_msg_number = self.app.redis_value("last_index", int, 1)
+        # Номер сообщения, которое будет сгенерировано. В last_index
+        # хранится номер последнего добавленного в очередь сообщения, а
+        # после генерации всех сообщений - msg_count + 1.
+        self.cur_msg_number = self.app.redis_value("last_index", int, 0) + 1
+
+        # Время последнего продления аренды роли генератора. Аренда
+        # продлена при захвате.
+        self.renew_ts = time.time()
+
+    # Продление аренды роли генератора не чаще, чем раз в треть её времени
+    # жизни. Возвращает False, если аренда потеряна. Если генератор
+    # подвиснет, аренда не будет продлена и истечёт.
+    def renew_lease(self):
+        if not self.app.lease:
+            return True
+        cur_ts = time.time()
+        if cur_ts - self.renew_ts < self.app.lease / 3:
+            return True
+        self.renew_ts = cur_ts
+        return self.app.renew_lease()
+
+    # Ожидание с продлением аренды. Возвращает False, если аренда потеряна.
+    def sleep(self, delay):
+        end_ts = time.time() + delay
+        while delay > 0.0:
+            if self.app.lease:
+                delay = min(delay, self.app.lease / 3)
+            time.sleep(delay)
+            if not self.renew_lease():
+                return False
+            delay = end_ts - time.time()
+        return True
 
     def run(self):
-        if self.cur_msg_number == self.app.msg_count + 1:
+        if self.cur_msg_number > self.app.msg_count:
+            self.app.rdb.set("last_index", self.app.msg_count+1)
+            return
+        if self.app.batch:
+            self.run_batched()
             return
         for i in range(self.cur_msg_number, self.app.msg_count + 1):
+            if not self.renew_lease():
+                return
             with self.gen_lock:
                 cur_ts = time.time()
                 if not self.start_ts:
                     self.start_ts = cur_ts
                     self.app.rdb.set("start", self.start_ts)
                 gen_name = self.app.redis_value("generator", str, "")
-                if gen_name != self.app.name:
+                if (gen_name != self.app.name or
+                        self.app.generator is not self):
                     return
-                self.app.rdb.set("last_index", i)
+                # Сообщение и его номер сохраняются одной транзакцией.
                 msg = generate_message(i)
-                self.app.rdb.rpush("queue", msg)
-                print("The generator: {name}. Time: {ts}. "
-                      "Generated: {msg}".format(
-                        name=self.app.name, ts=cur_ts, msg=msg))
+                pipe = self.app.rdb.pipeline()
+                pipe.rpush("queue", msg)
+                pipe.set("last_index", i)
+                pipe.execute()
+                self.app.metrics.inc("generated")
+                if not self.app.quiet:
+                    print("The generator: {name}. Time: {ts}. "
+                          "Generated: {msg}".format(
+                            name=self.app.name, ts=cur_ts, msg=msg))
                 delay = self.start_ts + self.app.interval * i - cur_ts
-                if delay > 0.0:
-                    time.sleep(delay)
+            if delay > 0.0 and not self.sleep(delay):
+                return
         self.app.rdb.set("last_index", self.app.msg_count+1)
 
+    # Пакетная генерация сообщений по расписанию RateScheduler. За одно
+    # пробуждение генерируются все сообщения, время которых наступило, с
+    # учётом способа восполнения пропущенных сообщений; в очередь за одно
+    # обращение к redis добавляется не более app.batch сообщений.
+    # Блокировка gen_lock не используется: проверка генератора и добавление
+    # сообщений выполняются атомарно скриптом PUSH_BATCH_SCRIPT.
+    def run_batched(self):
+        if self.app.backend == "streams":
+            push_batch = self.app.rdb.register_script(PUSH_STREAM_SCRIPT)
+            keys = ["generator", "last_index", STREAM_KEY]
+            extra_args = [self.app.stream_maxlen]
+        else:
+            push_batch = self.app.rdb.register_script(PUSH_BATCH_SCRIPT)
+            keys = ["generator", "last_index", "queue"]
+            extra_args = []
+        if not self.start_ts:
+            self.app.rdb.set("start", time.time(), nx=True)
+            self.start_ts = self.app.redis_value("start", float, 0.0)
+        sched = RateScheduler(self.app.interval, self.start_ts,
+                              self.cur_msg_number, self.app.catch_up,
+                              self.app.tick)
+        report_ts = time.time()
+        while sched.number <= self.app.msg_count:
+            cur_ts = time.time()
+            count = sched.take(cur_ts, self.app.msg_count - sched.number + 1)
+            if sched.start_ts != self.start_ts:
+                # Расписание сдвинуто, чтобы время сообщений, по которому
+                # другие приложения проверяют генератор, не отставало.
+                self.start_ts = sched.start_ts
+                self.app.rdb.set("start", self.start_ts)
+            while count:
+                if not self.renew_lease() or self.app.generator is not self:
+                    return
+                last = sched.number + min(count, self.app.batch) - 1
+                msgs = [generate_message(j)
+                        for j in range(sched.number, last + 1)]
+                if not push_batch(keys=keys,
+                                  args=[self.app.name, last] + extra_args +
+                                  msgs):
+                    return
+                self.app.metrics.inc("generated", len(msgs))
+                if not self.app.quiet:
+                    print("The generator: {name}. Time: {ts}. "
+                          "Generated: {first} - {last}".format(
+                            name=self.app.name, ts=cur_ts, first=msgs[0],
+                            last=msgs[-1]))
+                sched.done(len(msgs))
+                count -= len(msgs)
+            cur_ts = time.time()
+            if cur_ts - report_ts >= RATE_REPORT_PERIOD:
+                self.app.report_rate(sched.stats(cur_ts))
+                report_ts = cur_ts
+            delay = sched.delay(cur_ts)
+            if delay > 0.0 and not self.sleep(delay):
+                return
+        self.app.rdb.set("last_index", self.app.msg_count+1)
+        self.app.report_rate(sched.stats(time.time()))
+
 
 # Класс для создания потока приёма и генерации сообщений.
 class MsgAcceptor(threading.Thread):
@@ -86,54 +640,383 @@ class MsgAcceptor(threading.Thread):
         self.accept_lock = self.app.rdb.lock("accept_lock", 2)
 
     # Обработка текста сообщения и сохранение
-    # сообщений с ошибками в отдельной очереди.
+    # сообщений с ошибками в отдельной очереди. Возвращает признак ошибки и
+    # длительность обработки.
     def process(self, text):
         st = time.time()
         parts = text.split("-")
         if int(parts[1]) <= 5:
             self.app.rdb.rpush("errors", text)
-        else:
-            time.sleep(self.app.interval)
-        return time.time() - st
+            return True, time.time() - st
+        time.sleep(self.app.interval)
+        return False, time.time() - st
 
     def run(self):
+        if self.app.backend == "streams":
+            self.run_streams()
+            return
+        if self.app.workers:
+            self.run_workers()
+            return
+        if self.app.reliable:
+            self.run_reliable()
+            return
         while True:
             try:
                 with self.accept_lock:
-                    st = self.app.rdb.get("start")
-                    if not st:
-                        self.app.run_generator()
-                    msg = self.app.rdb.blpop("queue", 1)
-                    st = self.app.redis_value("start", float, 0.0)
-                    if not st:
-                        continue
-                    process_time = 0
-                    last_index = self.app.redis_value("last_index", int, 0)
-                    if last_index:
-                        if last_index == self.app.msg_count + 1:
-                            if not msg:
-                                break
-                        process_time = (last_index - 1) * self.app.interval
-                    expected_ts = st + process_time
-                    delta = time.time() - expected_ts
-                    if delta > self.app.max_interval:
-                        self.app.run_generator()
+                    # В режиме аренды генератор проверяет поток MsgMonitor,
+                    # поэтому при приёме сообщения время не проверяется.
+                    if self.app.lease:
+                        msg = self.app.rdb.blpop("queue", 1)
+                        if not msg and self.app.all_generated():
+                            break
+                    else:
+                        st = self.app.rdb.get("start")
+                        if not st:
+                            self.app.run_generator()
+                        msg = self.app.rdb.blpop("queue", 1)
+                        st = self.app.redis_value("start", float, 0.0)
+                        if not st:
+                            continue
+                        process_time = 0
+                        last_index = self.app.redis_value("last_index", int, 0)
+                        if last_index:
+                            if last_index == self.app.msg_count + 1:
+                                if not msg:
+                                    break
+                            process_time = (last_index - 1) * self.app.interval
+                        expected_ts = st + process_time
+                        delta = time.time() - expected_ts
+                        if delta > self.app.max_interval:
+                            self.app.run_generator()
             except redis.exceptions.LockError as exc:
                 print("Redis Exception: {}".format(exc))
             if msg:
                 accept_ts = time.time()
-                (index, text) = msg[1].decode("utf-8").split(":")
-                duration = self.process(text)
-                print("The app: {name}. Index: {ix}. "
-                      "Accepted: {msg}. Time (ms): {ts}. "
-                      "Process Duration (ms): {dur}.".format(
-                            name=self.app.name, ix=index, ts=accept_ts,
-                            msg=text, dur=duration))
+                (index, gen_ts, text) = parse_message(msg[1])
+                (error, duration) = self.process(text)
+                self.app.processed(index, gen_ts, text, accept_ts, duration,
+                                   error)
+        self.app.stopped.set()
+
+    # Параллельный приём сообщений без блокировки accept_lock. Сообщение
+    # атомарно переносится из очереди в список обработчика
+    # processing:<имя приложения> и удаляется из него только после
+    # обработки. Если приложение будет остановлено, сообщения из его списка
+    # вернёт в очередь поток MsgMonitor другого приложения. Проверка
+    # генератора также выполняется в потоке MsgMonitor.
+    def run_reliable(self):
+        processing = processing_key(self.app.name)
+        while True:
+            msg = self.app.rdb.blmove("queue", processing, 1,
+                                      "LEFT", "RIGHT")
+            if not msg:
+                if self.app.all_processed():
+                    break
+                continue
+            accept_ts = time.time()
+            (index, gen_ts, text) = parse_message(msg)
+            (error, duration) = self.process(text)
+            self.app.rdb.lrem(processing, 1, msg)
+            self.app.processed(index, gen_ts, text, accept_ts, duration,
+                               error)
+        self.app.stopped.set()
+        self.app.monitor.join()
+        self.app.unregister_consumer()
+
+    # Приём сообщений из потока группой потребителей STREAM_GROUP: за одно
+    # обращение читается до read_count сообщений (XREADGROUP), а после их
+    # обработки подтверждения (XACK) и сообщения с ошибками отправляются
+    # одной транзакцией. Сообщения, которые слишком долго не подтверждает
+    # остановленное приложение, забираются себе (XAUTOCLAIM) и
+    # обрабатываются повторно. Проверка генератора выполняется в потоке
+    # MsgMonitor.
+    def run_streams(self):
+        claim_start = "0-0"
+        claim_ts = 0.0
+        while True:
+            entries = []
+            if time.time() - claim_ts >= self.app.claim_idle / 2:
+                claim_ts = time.time()
+                (claim_start, entries) = self.app.claim_stale(claim_start)
+            if not entries:
+                response = self.app.rdb.xreadgroup(
+                                STREAM_GROUP, self.app.name, {STREAM_KEY: ">"},
+                                count=self.app.read_count, block=1000)
+                entries = response[0][1] if response else []
+            if not entries:
+                if self.app.all_processed():
+                    break
+                continue
+            self.process_entries(entries)
+        self.app.stopped.set()
+        self.app.monitor.join()
+        self.app.rdb.xgroup_delconsumer(STREAM_KEY, STREAM_GROUP,
+                                        self.app.name)
+
+    # Обработка прочитанных из потока сообщений. Сообщения, удалённые из
+    # потока из-за ограничения длины до обработки, только подтверждаются.
+    def process_entries(self, entries):
+        results = []
+        pipe = self.app.rdb.pipeline()
+        for entry_id, fields in entries:
+            if not fields:
+                continue
+            accept_ts = time.time()
+            (index, gen_ts, text) = parse_message(fields[b"msg"])
+            (error, duration) = process_text(text, self.app.interval)
+            if error:
+                pipe.xadd(ERRORS_STREAM_KEY, {"msg": text})
+            results.append((index, gen_ts, text, accept_ts, duration, error))
+        pipe.xack(STREAM_KEY, STREAM_GROUP,
+                  *[entry_id for entry_id, fields in entries])
+        pipe.execute()
+        for result in results:
+            self.app.processed(*result)
+
+    # Приём сообщений для пула обработчиков MsgWorkers. Сообщения, как и в
+    # режиме reliable, переносятся в список processing:<имя приложения>, а
+    # удаляются из него пулом после обработки. Если пул занят, приём
+    # приостанавливается. Если обработчик пула завершился аварийно, пул
+    # перезапускается. При непредвиденной ошибке приложение
+    # останавливается, не удаляя себя из множества consumers, чтобы
+    # другие приложения вернули его сообщения в очередь.
+    def run_workers(self):
+        processing = processing_key(self.app.name)
+        workers = MsgWorkers(self.app)
+        try:
+            while True:
+                if workers.failed:
+                    workers.restart()
+                workers.wait_slot()
+                msg = self.app.rdb.blmove("queue", processing, 1,
+                                          "LEFT", "RIGHT")
+                if not msg:
+                    workers.release_slot()
+                    workers.flush()
+                    if not workers.failed and self.app.all_processed():
+                        break
+                    continue
+                try:
+                    workers.submit(msg)
+                except BrokenExecutor as exc:
+                    print("Worker Exception: {}".format(exc))
+                    workers.restart()
+        finally:
+            workers.shutdown()
+            self.app.stopped.set()
+            self.app.monitor.join()
+        self.app.unregister_consumer()
+
+
+# Класс пула обработчиков сообщений одного приложения. Обработчиками могут
+# быть потоки или процессы. Ожидают обработки или обрабатываются не более
+# workers + queue_size сообщений. Подтверждения обработки (удаление из
+# списка processing:<имя приложения>) и сообщения с ошибками накапливаются и
+# отправляются в redis одной транзакцией: когда накопится workers
+# сообщений или когда не останется сообщений в обработке.
+class MsgWorkers(object):
+    def __init__(self, app):
+
+        # Ссылка на объект приложения.
+        self.app = app
+
+        # Пул обработчиков.
+        self.executor = self.create_executor()
+
+        # Ограничение количества принятых, но не обработанных сообщений.
+        self.slots = threading.BoundedSemaphore(
+                        self.app.workers + self.app.queue_size)
+
+        # Блокировка для накопленных результатов обработки.
+        self.lock = threading.Lock()
+
+        # Количество сообщений в обработке.
+        self.inflight = 0
+
+        # Обработанные сообщения, подтверждения которых ещё не отправлены.
+        self.done = []
+
+        # Сообщения с ошибками, которые ещё не сохранены.
+        self.errors = []
+
+        # Признак аварийного завершения обработчика: пул нужно
+        # перезапустить, а оставшиеся в списке processing:<имя приложения>
+        # сообщения вернуть в очередь.
+        self.failed = False
+
+    def create_executor(self):
+        if self.app.worker_type == "process":
+            return ProcessPoolExecutor(self.app.workers)
+        return ThreadPoolExecutor(self.app.workers)
+
+    def wait_slot(self):
+        self.slots.acquire()
+
+    def release_slot(self):
+        self.slots.release()
+
+    # Передача сообщения в пул обработчиков.
+    def submit(self, msg):
+        accept_ts = time.time()
+        (index, gen_ts, text) = parse_message(msg)
+        with self.lock:
+            self.inflight += 1
+        try:
+            future = self.executor.submit(process_text, text,
+                                          self.app.interval)
+        except BaseException:
+            with self.lock:
+                self.inflight -= 1
+            self.slots.release()
+            raise
+        future.add_done_callback(
+            lambda f: self.complete(msg, index, gen_ts, text, accept_ts, f))
+
+    # Учёт обработанного сообщения. Вызывается в потоке пула. Если
+    # обработчик завершился с исключением (например, процесс пула был
+    # остановлен), сообщение не обработано: оно остаётся в списке
+    # processing:<имя приложения> и будет возвращено в очередь при
+    # перезапуске пула (см. restart). Слот и счётчик сообщений в обработке
+    # освобождаются в любом случае, иначе приём сообщений остановится.
+    def complete(self, msg, index, gen_ts, text, accept_ts, future):
+        try:
+            (error, duration) = future.result()
+        except Exception as exc:
+            print("Worker Exception: {}".format(exc))
+            with self.lock:
+                self.inflight -= 1
+                self.failed = True
+            self.slots.release()
+            return
+        try:
+            with self.lock:
+                self.inflight -= 1
+                self.done.append(msg)
+                if error:
+                    self.errors.append(text)
+                if len(self.done) >= self.app.workers or not self.inflight:
+                    self.flush_locked()
+        finally:
+            self.slots.release()
+        self.app.processed(index, gen_ts, text, accept_ts, duration, error)
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    # Отправка накопленных подтверждений и сообщений с ошибками одной
+    # транзакцией. Вызывается под блокировкой self.lock.
+    def flush_locked(self):
+        if not self.done:
+            return
+        processing = processing_key(self.app.name)
+        pipe = self.app.rdb.pipeline()
+        if self.errors:
+            pipe.rpush("errors", *self.errors)
+        for msg in self.done:
+            pipe.lrem(processing, 1, msg)
+        pipe.execute()
+        self.done = []
+        self.errors = []
+
+    # Перезапуск пула после аварийного завершения обработчика. После
+    # остановки старого пула и отправки подтверждений в списке
+    # processing:<имя приложения> остаются только необработанные
+    # сообщения, они возвращаются в очередь.
+    def restart(self):
+        self.executor.shutdown(wait=True)
+        self.flush()
+        nmsg = self.app.requeue(self.app.name)
+        print("The app: {name}. Restarted the workers pool. Returned {n} "
+              "messages to the queue.".format(name=self.app.name, n=nmsg))
+        self.executor = self.create_executor()
+        self.failed = False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.flush()
+
+
+# Класс для создания потока, который в режиме параллельного приёма
+# сообщений проверяет работу генератора, продлевает время жизни
+# ключа consumer:<имя приложения> и возвращает в очередь сообщения
+# остановленных приложений. В режиме аренды поток пытается захватить
+# аренду роли генератора.
+class MsgMonitor(threading.Thread):
+    def __init__(self, app):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Ссылка на объект приложения.
+        self.app = app
+
+        # Период проверки. В режиме аренды генератор заменяется не позднее,
+        # чем через lease + lease / 4 после последнего продления аренды.
+        self.period = min(self.app.max_interval / 2,
+                          self.app.consumer_ttl / 3)
+        if self.app.lease:
+            self.period = min(self.period, self.app.lease / 4)
+
+    # Проверка генератора: если сообщения генерируются медленнее, чем
+    # позволяет max_interval, генератором становится текущее приложение.
+    def check_generator(self):
+        st = self.app.redis_value("start", float, 0.0)
+        if not st:
+            if not self.app.redis_value("generator", str, ""):
+                self.app.run_generator()
+            return
+        last_index = self.app.redis_value("last_index", int, 0)
+        if last_index == self.app.msg_count + 1:
+            return
+        expected_ts = st + max(last_index - 1, 0) * self.app.interval
+        if time.time() - expected_ts > self.app.max_interval:
+            self.app.run_generator()
+
+    # Проверка генератора в режиме аренды: пока генерация не закончена,
+    # выполняется попытка захватить аренду, которая удаётся только после
+    # её истечения. Время сообщений не проверяется.
+    def check_lease(self):
+        if not self.app.all_generated():
+            self.app.run_generator()
+
+    def run(self):
+        while not self.app.stopped.is_set():
+            if self.app.reliable:
+                self.app.heartbeat()
+            try:
+                if self.app.lease:
+                    self.check_lease()
+                else:
+                    self.check_generator()
+            except redis.exceptions.LockError as exc:
+                print("Redis Exception: {}".format(exc))
+            if self.app.reliable:
+                self.app.recover_orphans()
+            self.app.stopped.wait(self.period)
+
+
+# Учёт обработанного сообщения в метриках приложения и его вывод, если
+# приложение запущено без -q. Общая часть App и AsyncApp.
+def report_processed(app, index, gen_ts, text, accept_ts, duration, error):
+    app.metrics.observe(gen_ts, accept_ts, duration, error)
+    if app.quiet:
+        return
+    print("The app: {name}. Index: {ix}. "
+          "Accepted: {msg}. Time (ms): {ts}. "
+          "Process Duration (ms): {dur}.".format(
+                name=app.name, ix=index, ts=accept_ts,
+                msg=text, dur=duration))
+
 
 # Класс для создания приложения, запускающего приём и обработку сообщений,
 # а также при необходимости генерацию сообщений с необходимой частотой.
 class App(object):
-    def __init__(self, interval, max_interval, nmsg, rhost, rport):
+    def __init__(self, interval, max_interval, nmsg, rhost, rport,
+                 batch=0, reliable=False, workers=0, worker_type="thread",
+                 queue_size=0, lease=0, catch_up="burst", tick=0.001,
+                 quiet=False, metrics_port=0, metrics_period=0,
+                 backend="list", read_count=100, stream_maxlen=1000000):
 
         # Имя приложения.
         self.name = generate_appname()
@@ -148,22 +1031,102 @@ class App(object):
         # которого принимается решение о замене генератора.
         self.max_interval = max_interval
 
+        # Способ передачи сообщений из BACKENDS.
+        self.backend = backend
+
+        # Максимальное количество сообщений, добавляемых генератором в
+        # очередь за одно обращение к redis. Если 0, то сообщения
+        # генерируются по одному под блокировкой gen_lock. В поток
+        # сообщения добавляются только пакетами.
+        self.batch = batch
+        if self.backend == "streams" and not self.batch:
+            self.batch = 1
+
+        # Количество сообщений, читаемых из потока за одно обращение, и
+        # максимальная длина потока.
+        self.read_count = read_count
+        self.stream_maxlen = stream_maxlen
+
+        # Способ восполнения пропущенных сообщений в пакетном режиме.
+        self.catch_up = catch_up
+
+        # Минимальный период между пробуждениями генератора в пакетном
+        # режиме.
+        self.tick = tick
+
+        # Количество обработчиков сообщений в пуле приложения. Если 0, то
+        # сообщения обрабатываются потоком приёма.
+        self.workers = workers
+
+        # Тип обработчиков пула: thread или process.
+        self.worker_type = worker_type
+
+        # Количество принятых сообщений, ожидающих свободного обработчика.
+        self.queue_size = queue_size if queue_size else workers
+
+        # Параллельный приём сообщений без блокировки accept_lock. Пул
+        # обработчиков работает только в этом режиме.
+        self.reliable = reliable or workers > 0
+
+        # Время жизни ключа consumer:<имя приложения>. Если приложение не
+        # продлило его, приложение считается остановленным.
+        self.consumer_ttl = max(2 * self.max_interval, 1.0)
+
+        # Время, после которого неподтверждённое сообщение потока
+        # забирается другим приложением. Оно больше времени обработки
+        # прочитанной за одно обращение части сообщений.
+        self.claim_idle = max(self.consumer_ttl,
+                              2 * self.read_count * self.interval)
+
+        # Время жизни аренды роли генератора. Если 0, то отказ генератора
+        # определяется по времени сгенерированных сообщений.
+        self.lease = lease
+
+        # Событие завершения приёма сообщений.
+        self.stopped = threading.Event()
+
+        # Поток генерации сообщений, если приложение - генератор. Поток
+        # завершается, если его заменил новый.
+        self.generator = None
+
+        # Отключение вывода каждого сгенерированного и принятого сообщения.
+        self.quiet = quiet
+
+        # Метрики приложения.
+        self.metrics = Metrics(self.name)
+
+        # Период сохранения метрик в хеше metrics:<имя приложения>. Если 0,
+        # то метрики не сохраняются.
+        self.metrics_period = metrics_period
+
         # Ссылка на объект для работы с redis.
         self.rdb = redis.Redis(host=rhost, port=rport)
 
-        # Сигналы завершения, которые подавляются.
-        # Процесс можно завершить по kill -9.
-        self.signal_handlers = {
-            signal.SIGINT: None,
-            signal.SIGQUIT: None,
-            signal.SIGTERM: None,
-            signal.SIGTSTP: None
-        }
+        # Скрипты захвата и продления аренды роли генератора.
+        self.lease_acquire = self.rdb.register_script(LEASE_ACQUIRE_SCRIPT)
+        self.lease_renew = self.rdb.register_script(LEASE_RENEW_SCRIPT)
+
+        # Сигналы завершения, которые подавляются, и их прежние
+        # обработчики.
+        self.signal_handlers = dict.fromkeys(COMPLETION_SIGNALS)
 
         # Блокировка, используемая при приёме сообщений.
         self.gen_lock = self.rdb.lock("gen_lock", 1)
 
         self.disable_completion()
+        if metrics_port:
+            start_metrics_server(self.metrics, metrics_port)
+        if self.metrics_period:
+            self.reporter = threading.Thread(target=self.report_metrics,
+                                             daemon=True)
+            self.reporter.start()
+        if self.reliable:
+            self.heartbeat()
+        if self.backend == "streams":
+            self.create_group()
+        if self.reliable or self.lease or self.backend == "streams":
+            self.monitor = MsgMonitor(self)
+            self.monitor.start()
         self.acceptor = MsgAcceptor(self)
         self.acceptor.start()
         print("The '{name}' app started.".format(name=self.name))
@@ -176,13 +1139,175 @@ class App(object):
             return default
         return type_name(b_value.decode("utf-8"))
 
+    # Учёт и вывод обработанного сообщения.
+    def processed(self, index, gen_ts, text, accept_ts, duration, error):
+        report_processed(self, index, gen_ts, text, accept_ts, duration,
+                         error)
+
+    # Сохранение метрик в хеше metrics:<имя приложения> раз в
+    # metrics_period и после окончания приёма сообщений. Выполняется в
+    # отдельном потоке.
+    def report_metrics(self):
+        while True:
+            stopped = self.stopped.wait(self.metrics_period)
+            self.rdb.hset(metrics_key(self.name),
+                          mapping=self.metrics.snapshot())
+            if stopped:
+                return
+
+    # Ожидание окончания приёма сообщений и сохранения метрик.
+    def join(self):
+        self.acceptor.join()
+        if self.metrics_period:
+            self.reporter.join()
+
+    # Регистрация приложения в множестве consumers и продление времени жизни
+    # ключа consumer:<имя приложения>.
+    def heartbeat(self):
+        pipe = self.rdb.pipeline()
+        pipe.sadd("consumers", self.name)
+        pipe.set(consumer_key(self.name), 1,
+                 px=int(self.consumer_ttl * 1000))
+        pipe.execute()
+
+    # Удаление приложения из множества consumers при завершении.
+    def unregister_consumer(self):
+        pipe = self.rdb.pipeline()
+        pipe.srem("consumers", self.name)
+        pipe.delete(consumer_key(self.name))
+        pipe.execute()
+
+    # Возврат в очередь сообщений из списка processing:<name>. Каждое
+    # сообщение переносится атомарно, поэтому несколько приложений могут
+    # выполнять возврат одновременно. Возвращает количество сообщений.
+    def requeue(self, name):
+        nmsg = 0
+        while self.rdb.lmove(processing_key(name), "queue", "RIGHT", "LEFT"):
+            nmsg += 1
+        return nmsg
+
+    # Возврат в очередь сообщений приложений, которые не продлили время
+    # жизни своего ключа.
+    def recover_orphans(self):
+        for b_name in self.rdb.smembers("consumers"):
+            name = b_name.decode("utf-8")
+            if name == self.name or self.rdb.exists(consumer_key(name)):
+                continue
+            nmsg = self.requeue(name)
+            self.rdb.srem("consumers", name)
+            if nmsg:
+                print("The app: {name}. Recovered {n} messages of the "
+                      "'{dead}' app.".format(name=self.name, n=nmsg,
+                                             dead=name))
+
+    # Создание группы потребителей потока, если её ещё нет.
+    def create_group(self):
+        try:
+            self.rdb.xgroup_create(STREAM_KEY, STREAM_GROUP, "0",
+                                   mkstream=True)
+        except redis.exceptions.ResponseError as exc:
+            if not str(exc).startswith("BUSYGROUP"):
+                raise
+
+    # Захват сообщений потока, которые не подтверждены дольше claim_idle,
+    # начиная с идентификатора start. Возвращает идентификатор, с которого
+    # продолжить поиск, и захваченные сообщения.
+    def claim_stale(self, start):
+        response = self.rdb.xautoclaim(
+                        STREAM_KEY, STREAM_GROUP, self.name,
+                        int(self.claim_idle * 1000), start_id=start,
+                        count=self.read_count)
+        if response[1]:
+            print("The app: {name}. Claimed {n} stale messages.".format(
+                    name=self.name, n=len(response[1])))
+        return response[0].decode("utf-8"), response[1]
+
+    # Проверка того, что все сообщения потока доставлены и подтверждены.
+    # Последний доставленный идентификатор и количество неподтверждённых
+    # сообщений группы читаются одной командой.
+    def all_streamed(self):
+        last_id = self.rdb.xinfo_stream(STREAM_KEY)["last-generated-id"]
+        for group in self.rdb.xinfo_groups(STREAM_KEY):
+            if group["name"].decode("utf-8") == STREAM_GROUP:
+                return (group["last-delivered-id"] == last_id and
+                        not group["pending"])
+        return False
+
+    # Проверка того, что все сообщения сгенерированы.
+    def all_generated(self):
+        return self.redis_value("last_index", int, 0) == self.msg_count + 1
+
+    # Проверка того, что все сообщения сгенерированы и обработаны: очередь
+    # и списки обрабатываемых сообщений всех приложений пусты. Списки
+    # проверяются раньше очереди: сообщение остановленного приложения
+    # переносится из списка в очередь и не может быть пропущено.
+    def all_processed(self):
+        if self.redis_value("last_index", int, 0) != self.msg_count + 1:
+            return False
+        if self.backend == "streams":
+            return self.all_streamed()
+        for b_name in self.rdb.smembers("consumers"):
+            if self.rdb.llen(processing_key(b_name.decode("utf-8"))):
+                return False
+        if self.rdb.llen("queue"):
+            return False
+        return True
+
     # Подавление сигналов завершения.
     def disable_completion(self):
         for s in self.signal_handlers:
             self.signal_handlers[s] = signal.signal(s, completion_handler)
 
+    # Захват аренды роли генератора. Если предыдущий арендатор - другое
+    # приложение, то его аренда истекла, и приложение заменяет генератор.
+    # Время замены генератора отсчитывается от последнего продления аренды
+    # предыдущим генератором, выводится и сохраняется в списке failovers.
+    # Возвращает True, если аренда захвачена.
+    def acquire_lease(self):
+        prev = self.lease_acquire(keys=["generator", "generator_lease"],
+                                  args=[self.name, int(self.lease * 1000),
+                                        time.time()])
+        if prev is None:
+            return False
+        (prev_name, prev_ts) = prev
+        if prev_name and prev_name.decode("utf-8") != self.name:
+            self.metrics.inc("takeovers")
+            latency = time.time() - float(prev_ts)
+            prev_name = prev_name.decode("utf-8")
+            self.rdb.rpush("failovers", "{old} {new} {latency}".format(
+                            old=prev_name, new=self.name, latency=latency))
+            print("The app: {name}. Took over the generator from '{old}'. "
+                  "Failover latency (ms): {latency}.".format(
+                        name=self.name, old=prev_name,
+                        latency=latency * 1000))
+        return True
+
+    # Вывод и сохранение в хеше generator_rate заданной и достигнутой
+    # частоты генерации (см. RateScheduler.stats).
+    def report_rate(self, stats):
+        self.rdb.hset("generator_rate", mapping=dict(stats, name=self.name))
+        print("The generator: {name}. Target rate (msg/s): {target}. "
+              "Achieved rate (msg/s): {achieved}. Generated: {generated}. "
+              "Skipped: {skipped}. Max lag (ms): {lag}.".format(
+                    name=self.name, lag=stats["max_lag"] * 1000, **stats))
+
+    # Продление аренды роли генератора. Возвращает False, если аренда
+    # потеряна.
+    def renew_lease(self):
+        return bool(self.lease_renew(keys=["generator", "generator_lease"],
+                                     args=[self.name, int(self.lease * 1000),
+                                           time.time()]))
+
     # Запуск генератора сообщений в отдельном потоке.
     def run_generator(self):
+        if self.lease:
+            if self.generator is not None and self.generator.is_alive():
+                return
+            if not self.acquire_lease():
+                return
+            self.generator = MsgGenerator(self)
+            self.generator.start()
+            return
         try:
             with self.gen_lock:
                 gen_name = self.redis_value("generator", str, "")
@@ -191,11 +1316,304 @@ class App(object):
                 if self.name == gen_name:
                     return
                 self.rdb.set("generator", self.name)
+                if gen_name:
+                    self.metrics.inc("takeovers")
+                # Прежний поток генерации этого приложения, если роль
+                # генератора возвращается к приложению, пока он ждёт
+                # следующего сообщения, завершится, не добавив сообщений.
+                self.generator = MsgGenerator(self)
         except redis.exceptions.LockError as exc:
             print("Redis Exception: {}".format(exc))
             return
-        gen = MsgGenerator(self)
-        gen.start()
+        self.generator.start()
+
+
+# Класс приложения, в котором генерация сообщений, их приём и проверка
+# генератора выполняются сопрограммами в одном цикле событий asyncio.
+# Сообщения принимаются так же, как в режиме reliable, и генерируются
+# пакетами, как в режиме batch, поэтому приложения App и AsyncApp можно
+# запускать одновременно. Все сопрограммы используют один пул соединений
+# с redis заданного размера; блокирующий BLMOVE каждого приёмника занимает
+# одно соединение, поэтому размер пула должен быть больше количества
+# приёмников.
+class AsyncApp(object):
+    def __init__(self, interval, max_interval, nmsg, rhost, rport,
+                 batch=0, consumers=1, pool_size=0, catch_up="burst",
+                 tick=0.001, quiet=False, metrics_port=0, metrics_period=0,
+                 rdb=None):
+
+        # Имя приложения.
+        self.name = generate_appname()
+
+        # Количество генерируемых сообщений.
+        self.msg_count = nmsg
+
+        # Частота генерации сообщения.
+        self.interval = interval
+
+        # Максимальное время ожидания нового сообщения, по истечении
+        # которого принимается решение о замене генератора.
+        self.max_interval = max_interval
+
+        # Максимальное количество сообщений, добавляемых генератором в
+        # очередь за одно обращение к redis.
+        self.batch = batch if batch else 1
+
+        # Способ восполнения пропущенных сообщений и минимальный период
+        # между пробуждениями генератора (см. RateScheduler).
+        self.catch_up = catch_up
+        self.tick = tick
+
+        # Количество сопрограмм, принимающих сообщения.
+        self.consumers = consumers
+
+        # Время жизни ключа consumer:<имя приложения>.
+        self.consumer_ttl = max(2 * self.max_interval, 1.0)
+
+        # Событие завершения приёма сообщений.
+        self.stopped = asyncio.Event()
+
+        # Сопрограмма генерации сообщений, если приложение - генератор.
+        self.generator = None
+
+        # Отключение вывода сообщений, метрики приложения, порт
+        # HTTP-сервера метрик и период их сохранения в redis (см. App).
+        self.quiet = quiet
+        self.metrics = Metrics(self.name)
+        self.metrics_port = metrics_port
+        self.metrics_period = metrics_period
+
+        # Ссылка на объект для работы с redis. Объект можно передать
+        # снаружи, например, для работы с заменой redis в тестах.
+        if rdb is None:
+            if aioredis is None:
+                raise RuntimeError("redis.asyncio requires redis-py 4.2+")
+            pool = aioredis.BlockingConnectionPool(
+                        host=rhost, port=rport,
+                        max_connections=pool_size or consumers + 4)
+            rdb = aioredis.Redis(connection_pool=pool)
+        self.rdb = rdb
+
+    # Извлечение значения по ключу из redis и преобразование к нужному типу.
+    # Если ключа нет, то возвращается значение по умолчанию.
+    async def redis_value(self, name, type_name, default):
+        b_value = await self.rdb.get(name)
+        if not b_value:
+            return default
+        return type_name(b_value.decode("utf-8"))
+
+    # Запуск всех сопрограмм приложения и ожидание окончания приёма
+    # сообщений.
+    async def run(self):
+        self.disable_completion()
+        await self.heartbeat()
+        if self.metrics_port:
+            start_metrics_server(self.metrics, self.metrics_port)
+        print("The '{name}' app started.".format(name=self.name))
+        monitor = asyncio.ensure_future(self.monitor())
+        if self.metrics_period:
+            reporter = asyncio.ensure_future(self.report_metrics())
+        await asyncio.gather(*[self.consume()
+                               for i in range(self.consumers)])
+        self.stopped.set()
+        await monitor
+        if self.metrics_period:
+            await reporter
+        if self.generator is not None:
+            await self.generator
+        pipe = self.rdb.pipeline()
+        pipe.srem("consumers", self.name)
+        pipe.delete(consumer_key(self.name))
+        await pipe.execute()
+
+    # Подавление сигналов завершения (см. App.disable_completion). Сигналы
+    # обрабатываются в цикле событий, поэтому asyncio.run не прерывает
+    # приложение по SIGINT.
+    def disable_completion(self):
+        loop = asyncio.get_running_loop()
+        for s in COMPLETION_SIGNALS:
+            loop.add_signal_handler(s, completion_handler, s, None)
+
+    # Пакетная генерация сообщений (см. MsgGenerator.run_batched).
+    async def generate(self):
+        push_batch = self.rdb.register_script(PUSH_BATCH_SCRIPT)
+        start_ts = await self.redis_value("start", float, 0.0)
+        if not start_ts:
+            await self.rdb.set("start", time.time(), nx=True)
+            start_ts = await self.redis_value("start", float, 0.0)
+        # См. MsgGenerator.__init__: last_index - номер последнего
+        # добавленного сообщения.
+        sched = RateScheduler(self.interval, start_ts,
+                              await self.redis_value("last_index", int, 0) + 1,
+                              self.catch_up, self.tick)
+        report_ts = time.time()
+        while sched.number <= self.msg_count:
+            cur_ts = time.time()
+            count = sched.take(cur_ts, self.msg_count - sched.number + 1)
+            if sched.start_ts != start_ts:
+                start_ts = sched.start_ts
+                await self.rdb.set("start", start_ts)
+            while count:
+                last = sched.number + min(count, self.batch) - 1
+                msgs = [generate_message(j)
+                        for j in range(sched.number, last + 1)]
+                if not await push_batch(
+                        keys=["generator", "last_index", "queue"],
+                        args=[self.name, last] + msgs):
+                    return
+                self.metrics.inc("generated", len(msgs))
+                if not self.quiet:
+                    print("The generator: {name}. Time: {ts}. "
+                          "Generated: {first} - {last}".format(
+                            name=self.name, ts=cur_ts, first=msgs[0],
+                            last=msgs[-1]))
+                sched.done(len(msgs))
+                count -= len(msgs)
+            cur_ts = time.time()
+            if cur_ts - report_ts >= RATE_REPORT_PERIOD:
+                await self.report_rate(sched.stats(cur_ts))
+                report_ts = cur_ts
+            delay = sched.delay(cur_ts)
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+        await self.rdb.set("last_index", self.msg_count+1)
+        await self.report_rate(sched.stats(time.time()))
+
+    # Вывод и сохранение частоты генерации (см. App.report_rate).
+    async def report_rate(self, stats):
+        await self.rdb.hset("generator_rate",
+                            mapping=dict(stats, name=self.name))
+        print("The generator: {name}. Target rate (msg/s): {target}. "
+              "Achieved rate (msg/s): {achieved}. Generated: {generated}. "
+              "Skipped: {skipped}. Max lag (ms): {lag}.".format(
+                    name=self.name, lag=stats["max_lag"] * 1000, **stats))
+
+    # Учёт и вывод обработанного сообщения (см. App.processed).
+    def processed(self, index, gen_ts, text, accept_ts, duration, error):
+        report_processed(self, index, gen_ts, text, accept_ts, duration,
+                         error)
+
+    # Приём и обработка сообщений (см. MsgAcceptor.run_reliable). Сообщение
+    # с ошибкой сохраняется вместе с подтверждением обработки одной
+    # транзакцией.
+    async def consume(self):
+        processing = processing_key(self.name)
+        while True:
+            msg = await self.rdb.blmove("queue", processing, 1,
+                                        "LEFT", "RIGHT")
+            if not msg:
+                if await self.all_processed():
+                    break
+                continue
+            accept_ts = time.time()
+            (index, gen_ts, text) = parse_message(msg)
+            st = time.time()
+            parts = text.split("-")
+            error = int(parts[1]) <= 5
+            pipe = self.rdb.pipeline()
+            if error:
+                pipe.rpush("errors", text)
+            else:
+                await asyncio.sleep(self.interval)
+            pipe.lrem(processing, 1, msg)
+            await pipe.execute()
+            duration = time.time() - st
+            self.processed(index, gen_ts, text, accept_ts, duration, error)
+
+    # Сохранение метрик в хеше metrics:<имя приложения> (см.
+    # App.report_metrics).
+    async def report_metrics(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.stopped.wait(),
+                                       self.metrics_period)
+            except asyncio.TimeoutError:
+                pass
+            await self.rdb.hset(metrics_key(self.name),
+                                mapping=self.metrics.snapshot())
+            if self.stopped.is_set():
+                return
+
+    # Проверка генератора, продление времени жизни ключа
+    # consumer:<имя приложения> и возврат в очередь сообщений остановленных
+    # приложений (см. MsgMonitor).
+    async def monitor(self):
+        period = min(self.max_interval / 2, self.consumer_ttl / 3)
+        while not self.stopped.is_set():
+            await self.heartbeat()
+            try:
+                await self.check_generator()
+            except redis.exceptions.LockError as exc:
+                print("Redis Exception: {}".format(exc))
+            await self.recover_orphans()
+            try:
+                await asyncio.wait_for(self.stopped.wait(), period)
+            except asyncio.TimeoutError:
+                pass
+
+    async def check_generator(self):
+        st = await self.redis_value("start", float, 0.0)
+        if not st:
+            if not await self.redis_value("generator", str, ""):
+                await self.run_generator()
+            return
+        last_index = await self.redis_value("last_index", int, 0)
+        if last_index == self.msg_count + 1:
+            return
+        expected_ts = st + max(last_index - 1, 0) * self.interval
+        if time.time() - expected_ts > self.max_interval:
+            await self.run_generator()
+
+    async def heartbeat(self):
+        pipe = self.rdb.pipeline()
+        pipe.sadd("consumers", self.name)
+        pipe.set(consumer_key(self.name), 1,
+                 px=int(self.consumer_ttl * 1000))
+        await pipe.execute()
+
+    async def recover_orphans(self):
+        for b_name in await self.rdb.smembers("consumers"):
+            name = b_name.decode("utf-8")
+            if (name == self.name or
+                    await self.rdb.exists(consumer_key(name))):
+                continue
+            nmsg = 0
+            while await self.rdb.lmove(processing_key(name), "queue",
+                                       "RIGHT", "LEFT"):
+                nmsg += 1
+            await self.rdb.srem("consumers", name)
+            if nmsg:
+                print("The app: {name}. Recovered {n} messages of the "
+                      "'{dead}' app.".format(name=self.name, n=nmsg,
+                                             dead=name))
+
+    async def all_processed(self):
+        if (await self.redis_value("last_index", int, 0) !=
+                self.msg_count + 1):
+            return False
+        for b_name in await self.rdb.smembers("consumers"):
+            if await self.rdb.llen(processing_key(b_name.decode("utf-8"))):
+                return False
+        if await self.rdb.llen("queue"):
+            return False
+        return True
+
+    # Захват функций генератора и запуск сопрограммы генерации.
+    async def run_generator(self):
+        if self.generator is not None and not self.generator.done():
+            return
+        try:
+            async with self.rdb.lock("gen_lock", 1):
+                gen_name = await self.redis_value("generator", str, "")
+                if self.name == gen_name:
+                    return
+                await self.rdb.set("generator", self.name)
+                if gen_name:
+                    self.metrics.inc("takeovers")
+        except redis.exceptions.LockError as exc:
+            print("Redis Exception: {}".format(exc))
+            return
+        self.generator = asyncio.ensure_future(self.generate())
 
 
 def main():
@@ -208,21 +1626,122 @@ def main():
                 description="Генератор и обработчик сообщений.")
     parser.add_argument("-c", "--command",
                         default="handle", type=str,
-                        choices=["handle", "getErrors", "clean"],
+                        choices=["handle", "getErrors", "getFailovers",
+                                 "clean"],
                         help="Выполняемое действие: handle - "
                              "генерация и обработка сообщений; getErrors - "
-                             "получение сообщений с ошиками; clean - "
+                             "получение сообщений с ошиками; getFailovers - "
+                             "вывод замен генератора в режиме аренды и их "
+                             "времени; clean - "
                              "очистка используемых ключей со старыми "
                         "значениями. Значение по умолчанию: handle")
-    parser.add_argument("-i", "--interval", default=500, type=int,
-                        help="Интервал между сообщениями (мс). "
-                             "Значение по умолчанию - 500 мс.")
+    parser.add_argument("-i", "--interval", default=500, type=float,
+                        help="Интервал между сообщениями (мс), может быть "
+                             "дробным. Значение по умолчанию - 500 мс.")
     parser.add_argument("-m", "--max-interval", default=900, type=int,
                         help="Maксимальный интервал между сообщениями (мс). "
                              "Значение по умолчанию - 900 мс.")
     parser.add_argument("-n", "--number", default=100, type=int,
                         help="Количество генерируемых сообщений. "
                         "Значение по умолчанию: 100.")
+    parser.add_argument("-b", "--batch", default=0, type=int,
+                        help="Максимальное количество сообщений, которые "
+                             "генератор добавляет в очередь за одно "
+                             "обращение к redis (с помощью Lua-скрипта). "
+                             "Значение по умолчанию: 0 - сообщения "
+                             "генерируются по одному под блокировкой.")
+    parser.add_argument("--catch-up", default="burst", type=str,
+                        choices=CATCH_UP_MODES,
+                        help="Восполнение пропущенных сообщений в пакетном "
+                             "режиме, если генератор отстал от расписания: "
+                             "burst - сразу; skip - не восполнять, сдвинув "
+                             "расписание; smooth - с удвоенной частотой. "
+                             "Значение по умолчанию: burst.")
+    parser.add_argument("--tick", default=1, type=float,
+                        help="Минимальный период пробуждения генератора в "
+                             "пакетном режиме (мс). За одно пробуждение "
+                             "генерируются все сообщения, время которых "
+                             "наступило. Значение по умолчанию: 1 мс.")
+    parser.add_argument("-r", "--reliable", action="store_true",
+                        help="Параллельный приём сообщений без блокировки "
+                             "accept_lock: сообщение переносится из очереди "
+                             "в список обработчика (BLMOVE) и удаляется из "
+                             "него после обработки, а сообщения "
+                             "остановленных приложений возвращаются в "
+                             "очередь.")
+    parser.add_argument("-w", "--workers", default=0, type=int,
+                        help="Количество обработчиков сообщений в пуле "
+                             "приложения. Включает режим reliable: сообщение "
+                             "удаляется из списка обработчика после "
+                             "обработки, а сообщения с ошибками сохраняются "
+                             "пакетами. Значение по умолчанию: 0 - сообщения "
+                             "обрабатываются потоком приёма.")
+    parser.add_argument("--worker-type", default="thread", type=str,
+                        choices=["thread", "process"],
+                        help="Тип обработчиков пула: потоки или процессы. "
+                             "Значение по умолчанию: thread.")
+    parser.add_argument("--queue-size", default=0, type=int,
+                        help="Количество принятых сообщений, ожидающих "
+                             "свободного обработчика пула. Значение по "
+                             "умолчанию равно количеству обработчиков.")
+    parser.add_argument("-l", "--lease", default=0, type=int,
+                        help="Время жизни аренды роли генератора (мс). "
+                             "Генератор продлевает аренду, остальные "
+                             "приложения заменяют его после её истечения. "
+                             "Значение по умолчанию: 0 - отказ генератора "
+                             "определяется по времени сообщений.")
+    parser.add_argument("--async", action="store_true", dest="use_async",
+                        help="Генерация, приём сообщений и проверка "
+                             "генератора выполняются сопрограммами asyncio "
+                             "с общим пулом соединений с redis.")
+    parser.add_argument("--consumers", default=1, type=int,
+                        help="Количество сопрограмм, принимающих сообщения, "
+                             "в режиме async. Значение по умолчанию: 1.")
+    parser.add_argument("--pool-size", default=0, type=int,
+                        help="Размер пула соединений с redis в режиме async. "
+                             "Значение по умолчанию: количество "
+                             "сопрограмм приёма + 4.")
+    parser.add_argument("--backend", default="list", type=str,
+                        choices=BACKENDS,
+                        help="Способ передачи сообщений: list - список "
+                             "redis; streams - поток redis с группой "
+                             "потребителей. Значение по умолчанию: list.")
+    parser.add_argument("--read-count", default=100, type=int,
+                        help="Количество сообщений, читаемых из потока за "
+                             "одно обращение к redis. Значение по "
+                             "умолчанию: 100.")
+    parser.add_argument("--stream-maxlen", default=1000000, type=int,
+                        help="Приблизительная максимальная длина потока "
+                             "сообщений. Значение по умолчанию: 1000000.")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Не выводить каждое сгенерированное и "
+                             "принятое сообщение.")
+    parser.add_argument("--metrics-port", default=0, type=int,
+                        help="Порт HTTP-сервера на 127.0.0.1, "
+                             "возвращающего метрики приложения в формате "
+                             "Prometheus по адресу /metrics. Значение по "
+                             "умолчанию: 0 - сервер не запускается.")
+    parser.add_argument("--metrics-period", default=0, type=float,
+                        help="Период сохранения метрик приложения в хеше "
+                             "metrics:<имя приложения> (мс). Значение по "
+                             "умолчанию: 0 - метрики не сохраняются.")
+    parser.add_argument("--errors-format", default="text", type=str,
+                        choices=ERRORS_FORMATS,
+                        help="Формат вывода команды getErrors: text - "
+                             "пронумерованные строки; json - JSON-объекты "
+                             "по одному в строке. Значение по умолчанию: "
+                             "text.")
+    parser.add_argument("--peek", action="store_true",
+                        help="Команда getErrors выводит сообщения с "
+                             "ошибками, не удаляя их.")
+    parser.add_argument("--limit", default=0, type=int,
+                        help="Максимальное количество сообщений, выводимых "
+                             "командой getErrors. Значение по умолчанию: 0 "
+                             "- все сообщения.")
+    parser.add_argument("--drain-batch", default=10000, type=int,
+                        help="Количество сообщений с ошибками, извлекаемых "
+                             "командой getErrors за одно обращение к redis. "
+                             "Значение по умолчанию: 10000.")
     parser.add_argument("-t", "--host", default="localhost", type=str,
                         help="Имя хоста с redis. "
                              "Значение по умолчанию: localhost")
@@ -230,22 +1749,51 @@ def main():
                         help="Порт, на котором redis принимает соединения. "
                              "Значение по умолчанию: 6379")
     args = parser.parse_args()
+    if args.backend == "streams" and (args.reliable or args.workers or
+                                      args.use_async):
+        parser.error("--backend streams can't be used with --reliable, "
+                     "--workers or --async")
+    if args.use_async and (args.reliable or args.workers or args.lease):
+        parser.error("--async can't be used with --reliable, --workers or "
+                     "--lease")
 
-    if args.command == "handle": # Режим обработки сообщений.
-        App(args.interval/1000, args.max_interval/1000,
-            args.number, args.host, args.port)
+    if args.command == "handle" and args.use_async:
+        app = AsyncApp(args.interval/1000, args.max_interval/1000,
+                       args.number, args.host, args.port, args.batch,
+                       args.consumers, args.pool_size, args.catch_up,
+                       args.tick/1000, args.quiet, args.metrics_port,
+                       args.metrics_period/1000)
+        asyncio.run(app.run())
+    elif args.command == "handle": # Режим обработки сообщений.
+        app = App(args.interval/1000, args.max_interval/1000,
+                  args.number, args.host, args.port, args.batch,
+                  args.reliable, args.workers, args.worker_type,
+                  args.queue_size, args.lease/1000, args.catch_up,
+                  args.tick/1000, args.quiet, args.metrics_port,
+                  args.metrics_period/1000, args.backend, args.read_count,
+                  args.stream_maxlen)
+        # Пул обработчиков не принимает задачи после начала завершения
+        # интерпретатора, поэтому основной поток дожидается окончания
+        # приёма сообщений.
+        app.join()
     elif args.command == "getErrors": # Режим получения сообщений с ошибками.
         rdb = redis.Redis(host=args.host, port=args.port)
-        nerrors = rdb.llen("errors")
-        i = 1
-        while nerrors:
-            message = rdb.lpop("errors")
-            if message:
-                message = message.decode("utf-8")
-            print("{number}. Message with error: {msg}".format(number=i,
-                                                               msg=message))
-            nerrors -= 1
-            i += 1
+        drain_errors(rdb, sys.stdout, args.drain_batch, args.limit,
+                     args.peek, args.errors_format, args.backend)
+    elif args.command == "getFailovers": # Режим вывода замен генератора.
+        rdb = redis.Redis(host=args.host, port=args.port)
+        latencies = []
+        for i, failover in enumerate(rdb.lrange("failovers", 0, -1), 1):
+            (old, new, latency) = failover.decode("utf-8").split(" ")
+            latencies.append(float(latency) * 1000)
+            print("{number}. Generator failover: {old} -> {new}. "
+                  "Latency (ms): {latency}.".format(
+                        number=i, old=old, new=new, latency=latencies[-1]))
+        if latencies:
+            print("Failovers: {n}. Latency (ms): min {min}, avg {avg}, "
+                  "max {max}.".format(n=len(latencies), min=min(latencies),
+                                      avg=sum(latencies) / len(latencies),
+                                      max=max(latencies)))
     elif args.command == "clean": # Режим очистки используемых ключей.
         rdb = redis.Redis(host=args.host, port=args.port)
         rdb.delete("generator")
@@ -255,6 +1803,15 @@ def main():
         rdb.delete("gen_lock")
         rdb.delete("accept_lock")
         rdb.delete("errors")
+        rdb.delete("consumers")
+        rdb.delete("generator_lease")
+        rdb.delete("failovers")
+        rdb.delete("generator_rate")
+        rdb.delete(STREAM_KEY)
+        rdb.delete(ERRORS_STREAM_KEY)
+        for pattern in ("processing:*", "consumer:*", "metrics:*"):
+            for key in rdb.scan_iter(pattern):
+                rdb.delete(key)
 
 
 if __name__ == "__main__":